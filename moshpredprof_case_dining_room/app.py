@@ -1,18 +1,58 @@
+import atexit
+import csv
+import hashlib
+import heapq
+import io
+import json
 import os
+import queue
+import re
+import secrets
+import socket
 import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, date, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
+from itertools import islice
 
+import click
+
+import columnar
+import exports
+import passwords
 from flask import (
     Flask, request, render_template, redirect, session,
-    send_from_directory, url_for, render_template_string
+    send_from_directory, url_for, g, Response, jsonify, make_response
 )
 
 app = Flask(__name__)
 app.secret_key = "change_me_please"
 
 DB_PATH = "database.db"
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT_MS = 5000
+SESSION_TTL = 7 * 24 * 3600  # idle seconds before a login expires
+SESSION_CACHE_SIZE = 10000
+SESSION_PROFILE_TTL = 300  # seconds a cached profile (balance etc.) is trusted before re-reading users
+SESSION_TOUCH_INTERVAL = 300  # how often the sliding expiry is written back
+SESSIONS_ASYNC = True  # False (or app.testing) writes session updates synchronously
+NOTICES_ASYNC = True  # False (or app.testing) writes notices synchronously
+NOTICE_FLUSH_MS = 200
+NOTICE_BATCH_SIZE = 100
+LIVE_POLL_INTERVAL = 1.0  # seconds between notice polls while someone listens
+LIVE_KEEPALIVE = 15
 REPORTS_DIR = "reports_files"
+EXPORT_BATCH_ROWS = 1000
+REPORTS_ASYNC = True  # False (or app.testing) builds reports inside the request
+REPORT_WORKERS = 2
+BALANCE_CHECKPOINT_EVERY = 50  # transactions per student between running-balance checkpoints
+BULK_TOPUP_MAX_ROWS = 5000
+SUBSCRIPTION_SWEEP_INTERVAL = 3600  # seconds between expiry sweeps
+SUBSCRIPTION_NOTICE_DAYS = 3  # warn this many days before a subscription ends
+SUBSCRIPTION_CACHE_TTL = 30  # seconds; bounds staleness across processes, purchases here update at once
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
 def now_ts() -> str:
@@ -23,14 +63,52 @@ def today_str() -> str:
     return date.today().isoformat()
 
 
+def day_range(day: str):
+    # ts is "YYYY-MM-DD HH:MM:SS", so a day is the half-open range [day, next day)
+    return day, (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -8000")
     return conn
 
 
+# One connection per request (kept on g), recycled through a small pool.
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+def get_db():
+    conn = g.get("db")
+    if conn is None:
+        try:
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            conn = get_db_connection()
+        g.db = conn
+    return conn
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
 def init_db():
     conn = get_db_connection()
+    conn.execute("PRAGMA journal_mode = WAL")
     cur = conn.cursor()
 
     cur.execute("""
@@ -174,29 +252,699 @@ def init_db():
     """)
 
     conn.commit()
+    migrate_db(conn)
     conn.close()
 
 
-def add_notice(title: str, text: str, sender: str, recipient: str):
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO notices (ts, title, text, sender, recipient) VALUES (?, ?, ?, ?, ?)",
-        (now_ts(), title, text, sender, recipient),
+def meal_key(meal_type):
+    # Menu items may carry Russian meal names; analytics groups by breakfast/lunch/snack.
+    return MEAL_KEYS.get((meal_type or "").strip().lower(), meal_type)
+
+
+def rollup_serves(conn, day: str, meal_type: str, student_ids):
+    meal = meal_key(meal_type)
+    added = conn.executemany(
+        "INSERT OR IGNORE INTO analytics_attendance_seen(day, meal, student_id) VALUES(?,?,?)",
+        [(day, meal, sid) for sid in student_ids]
+    ).rowcount
+    if added > 0:
+        conn.execute("""
+            INSERT INTO analytics_attendance(day, meal, students) VALUES(?,?,?)
+            ON CONFLICT(day, meal) DO UPDATE SET students = students + excluded.students
+        """, (day, meal, added))
+
+
+def rollup_writeoff(conn, day: str, item: str, reason: str, count: int):
+    conn.execute("""
+        INSERT INTO analytics_writeoffs(day, item, reason, count) VALUES(?,?,?,?)
+        ON CONFLICT(day, item, reason) DO UPDATE SET count = count + excluded.count
+    """, (day, item, reason, count))
+
+
+def rebuild_analytics(conn, since: str = ""):
+    conn.create_function("meal_key", 1, meal_key, deterministic=True)
+    for table in ("analytics_attendance_seen", "analytics_attendance", "analytics_writeoffs"):
+        conn.execute(f"DELETE FROM {table} WHERE day >= ?", (since,))
+    conn.execute("""
+        INSERT OR IGNORE INTO analytics_attendance_seen(day, meal, student_id)
+        SELECT substr(ts,1,10), meal_key(meal_type), student_id FROM serves WHERE ts >= ?
+    """, (since,))
+    conn.execute("""
+        INSERT INTO analytics_attendance(day, meal, students)
+        SELECT day, meal, COUNT(*) FROM analytics_attendance_seen WHERE day >= ? GROUP BY day, meal
+    """, (since,))
+    conn.execute("""
+        INSERT INTO analytics_writeoffs(day, item, reason, count)
+        SELECT substr(ts,1,10), item, reason, SUM(count) FROM writeoffs WHERE ts >= ?
+        GROUP BY substr(ts,1,10), item, reason
+    """, (since,))
+
+
+def open_balance_checkpoints(conn, where: str = "1", params=()):
+    # Takes users.balance as the truth at each user's latest transaction, so balances that
+    # predate the ledger (seed data, rows from before checkpoints) start from a known point.
+    conn.execute(f"""
+        INSERT OR REPLACE INTO balance_checkpoints(student_id, tx_id, ts, balance)
+        SELECT u.id, COALESCE((SELECT MAX(t.id) FROM transactions t WHERE t.student_id = u.id), 0), ?, u.balance
+        FROM users u WHERE {where}
+    """, (now_ts(), *params))
+
+
+# Schema migrations, applied in order; PRAGMA user_version holds how many ran.
+# A step is either an SQL statement or a callable taking the connection.
+def create_user_search(conn):
+    # External-content FTS5 index over name/login/class; only those columns' updates touch it.
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                name, login, work, content='users', content_rowid='id', prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError:
+        return  # SQLite without FTS5: user_search_condition falls back to LIKE
+    for trigger in (
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts(rowid, name, login, work) VALUES (new.id, new.name, new.login, new.work);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, name, login, work) VALUES ('delete', old.id, old.name, old.login, old.work);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF name, login, work ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, name, login, work) VALUES ('delete', old.id, old.name, old.login, old.work);
+            INSERT INTO users_fts(rowid, name, login, work) VALUES (new.id, new.name, new.login, new.work);
+        END
+        """,
+    ):
+        conn.execute(trigger)
+    conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+# Tables the period reports read; triggers bump their data_versions row on every write.
+# users is versioned as well (migration 13), but only for changes to the class or role reports group by.
+VERSIONED_TABLES = ("serves", "writeoffs", "orders", "procurement", "complaints")
+
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_serves_ts ON serves(ts, item, count)",
+        "CREATE INDEX IF NOT EXISTS idx_serves_student ON serves(student_id)",
+        "CREATE INDEX IF NOT EXISTS idx_writeoffs_ts ON writeoffs(ts, item, count)",
+        "CREATE INDEX IF NOT EXISTS idx_menu_items_date ON menu_items(menu_date)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_student ON orders(student_id)",
+        "CREATE INDEX IF NOT EXISTS idx_complaints_student ON complaints(student_id)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_student ON subscriptions(student_id, until_date)",
+        "CREATE INDEX IF NOT EXISTS idx_notices_recipient ON notices(recipient)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_student ON transactions(student_id)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS stock_ledger (
+            day TEXT NOT NULL,
+            item TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            served INTEGER NOT NULL DEFAULT 0,
+            written_off INTEGER NOT NULL DEFAULT 0,
+            available INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, item)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_stock_ledger_available ON stock_ledger(day, available)",
+        """
+        INSERT OR REPLACE INTO stock_ledger(day, item, total, available)
+        SELECT menu_date, name, SUM(portions_total), SUM(portions_available)
+        FROM menu_items GROUP BY menu_date, name
+        """,
+        """
+        UPDATE stock_ledger SET
+            served = (SELECT IFNULL(SUM(count),0) FROM serves
+                      WHERE ts >= stock_ledger.day AND ts < date(stock_ledger.day, '+1 day')
+                        AND item = stock_ledger.item),
+            written_off = (SELECT IFNULL(SUM(count),0) FROM writeoffs
+                           WHERE ts >= stock_ledger.day AND ts < date(stock_ledger.day, '+1 day')
+                             AND item = stock_ledger.item)
+        """,
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS analytics_attendance_seen (
+            day TEXT NOT NULL,
+            meal TEXT NOT NULL,
+            student_id INTEGER NOT NULL,
+            PRIMARY KEY (day, meal, student_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS analytics_attendance (
+            day TEXT NOT NULL,
+            meal TEXT NOT NULL,
+            students INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, meal)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS analytics_writeoffs (
+            day TEXT NOT NULL,
+            item TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, item, reason)
+        ) WITHOUT ROWID
+        """,
+        rebuild_analytics,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_transactions_ts ON transactions(ts)",
+        "CREATE INDEX IF NOT EXISTS idx_procurement_ts ON procurement(ts)",
+    ],
+    [
+        "ALTER TABLE reports ADD COLUMN status TEXT NOT NULL DEFAULT 'done'",  # queued/running/done/failed
+        "ALTER TABLE reports ADD COLUMN fmt TEXT NOT NULL DEFAULT 'txt'",
+        "ALTER TABLE reports ADD COLUMN period_from TEXT",
+        "ALTER TABLE reports ADD COLUMN period_to TEXT",
+        "ALTER TABLE reports ADD COLUMN granularity TEXT",
+        "ALTER TABLE reports ADD COLUMN created_by INTEGER",
+        "ALTER TABLE reports ADD COLUMN finished_ts TEXT",
+        "ALTER TABLE reports ADD COLUMN error TEXT",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        "INSERT OR IGNORE INTO data_versions(name) VALUES " + ",".join(f"('{t}')" for t in VERSIONED_TABLES),
+        *[f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{t}_{op.lower()}_version AFTER {op} ON {t}
+        BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{t}'; END
+        """ for t in VERSIONED_TABLES for op in ("INSERT", "UPDATE", "DELETE")],
+        "ALTER TABLE reports ADD COLUMN data_version TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_reports_period ON reports(period_from, period_to, granularity, fmt)",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_role_work ON users(role, work)",
+        create_user_search,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_menu_items_date_meal ON menu_items(menu_date, meal_type)",
+        "DROP INDEX IF EXISTS idx_menu_items_date",
+        """
+        CREATE TABLE IF NOT EXISTS menu_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            staff_id INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS menu_template_items (
+            template_id INTEGER NOT NULL,
+            weekday INTEGER NOT NULL,          -- 0 = Monday
+            name TEXT NOT NULL,
+            meal_type TEXT NOT NULL,
+            price INTEGER NOT NULL DEFAULT 0,
+            kcal INTEGER NOT NULL DEFAULT 0,
+            allergens TEXT,
+            portions INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_menu_template_items ON menu_template_items(template_id, weekday)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            profile TEXT,                      -- JSON snapshot of the users row; NULL = reload
+            created_ts TEXT NOT NULL,
+            expires REAL NOT NULL              -- unix time
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS balance_checkpoints (
+            student_id INTEGER NOT NULL,
+            tx_id INTEGER NOT NULL,            -- last transaction included; 0 = before any
+            ts TEXT NOT NULL,
+            balance INTEGER NOT NULL,          -- running balance after tx_id
+            PRIMARY KEY (student_id, tx_id)
+        )
+        """,
+        open_balance_checkpoints,
+    ],
+    [
+        "ALTER TABLE users ADD COLUMN active_until TEXT",  # last day of the running subscription
+        """
+        UPDATE users SET active_until = (
+            SELECT MAX(until_date) FROM subscriptions s
+            WHERE s.student_id = users.id AND s.until_date >= date('now', 'localtime')
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_active_until ON users(active_until) WHERE active_until IS NOT NULL",
+        """
+        CREATE TABLE IF NOT EXISTS subscription_reminders (
+            student_id INTEGER NOT NULL,
+            until_date TEXT NOT NULL,
+            PRIMARY KEY (student_id, until_date)
+        )
+        """,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_serves_order ON serves(order_id) WHERE order_id IS NOT NULL",
+    ],
+    [
+        "INSERT OR IGNORE INTO data_versions(name) VALUES ('users')",
+        *[f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_{name}_version AFTER {event} ON users
+        BEGIN UPDATE data_versions SET version = version + 1 WHERE name = 'users'; END
+        """ for name, event in (("insert", "INSERT"), ("update", "UPDATE OF work, role"), ("delete", "DELETE"))],
+    ],
+    [
+        "ALTER TABLE reports ADD COLUMN owner TEXT",  # host:pid of the process whose pool runs the job
+    ],
+]
+
+
+LEDGER_UPSERT_SQL = """
+    INSERT INTO stock_ledger(day, item, total, served, written_off, available)
+    VALUES(?,?,?,?,?,?)
+    ON CONFLICT(day, item) DO UPDATE SET
+        total = total + excluded.total,
+        served = served + excluded.served,
+        written_off = written_off + excluded.written_off,
+        available = available + excluded.available
+"""
+
+
+def ledger_add(conn, day: str, item: str, total: int = 0, served: int = 0, written_off: int = 0):
+    # Per-day, per-dish stock counters; call inside the transaction that changes the stock.
+    conn.execute(LEDGER_UPSERT_SQL, (day, item, total, served, written_off, total - served - written_off))
+
+
+# Ledger balance per user: latest checkpoint plus the transactions after it.
+LEDGER_BALANCE_SQL = """
+    WITH latest AS (
+        SELECT u.id AS student_id, u.balance AS stored,
+               COALESCE(c.tx_id, 0) AS tx_id, COALESCE(c.balance, 0) AS balance
+        FROM users u LEFT JOIN balance_checkpoints c ON c.student_id = u.id
+            AND c.tx_id = (SELECT MAX(tx_id) FROM balance_checkpoints WHERE student_id = u.id)
+        WHERE {where}
     )
-    conn.commit()
+    SELECT l.student_id, l.stored, l.balance + COALESCE(SUM(t.amount), 0) AS balance,
+           COUNT(t.id) AS tail, COALESCE(MAX(t.id), l.tx_id) AS last_tx
+    FROM latest l LEFT JOIN transactions t ON t.student_id = l.student_id AND t.id > l.tx_id
+    GROUP BY l.student_id
+"""
+
+
+def ledger_balances(conn, ids=None):
+    if ids is None:
+        return conn.execute(LEDGER_BALANCE_SQL.format(where="1")).fetchall()
+    return conn.execute(LEDGER_BALANCE_SQL.format(where="u.id IN (SELECT value FROM json_each(?))"),
+                        (json.dumps(list(ids)),)).fetchall()
+
+
+def checkpoint_balances(conn, ids=None, every: int = BALANCE_CHECKPOINT_EVERY) -> int:
+    # Call inside the transaction that added the transactions.
+    ts = now_ts()
+    rows = [(r["student_id"], r["last_tx"], ts, r["balance"])
+            for r in ledger_balances(conn, ids) if r["tail"] and r["tail"] >= every]
+    conn.executemany(
+        "INSERT OR REPLACE INTO balance_checkpoints(student_id, tx_id, ts, balance) VALUES(?,?,?,?)", rows)
+    return len(rows)
+
+
+def running_balances(conn, student_id: int, tx_ids) -> dict:
+    """Balance after each of ``tx_ids``, summed from the nearest checkpoint rather than from the start."""
+    if not tx_ids:
+        return {}
+    lo, hi = min(tx_ids), max(tx_ids)
+    base = conn.execute("""
+        SELECT tx_id, balance FROM balance_checkpoints WHERE student_id = ? AND tx_id <= ?
+        ORDER BY tx_id DESC LIMIT 1
+    """, (student_id, hi)).fetchone() or conn.execute("""
+        SELECT tx_id, balance FROM balance_checkpoints WHERE student_id = ? AND tx_id > ?
+        ORDER BY tx_id LIMIT 1
+    """, (student_id, hi)).fetchone()
+    base_tx, base_balance = (base["tx_id"], base["balance"]) if base else (0, 0)
+    rows = conn.execute(
+        "SELECT id, amount FROM transactions WHERE student_id = ? AND id >= ? AND id <= ? ORDER BY id",
+        (student_id, min(lo, base_tx + 1), max(hi, base_tx))).fetchall()
+
+    after = {}
+    balance = base_balance
+    for r in rows:
+        if r["id"] > base_tx:
+            balance += r["amount"]
+            after[r["id"]] = balance
+    balance = base_balance
+    for r in reversed(rows):
+        if r["id"] <= base_tx:
+            after[r["id"]] = balance
+            balance -= r["amount"]
+    return {i: after.get(i) for i in tx_ids}
+
+
+def data_version(conn) -> str:
+    return ",".join(f"{name}:{version}" for name, version in
+                    conn.execute("SELECT name, version FROM data_versions ORDER BY name"))
+
+
+def migrate_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for num, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Each version commits together with its user_version bump, so a failed step leaves
+        # the schema at the previous version and the whole step reruns on the next start.
+        conn.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {num}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+INSERT_NOTICE_SQL = "INSERT INTO notices (ts, title, text, sender, recipient) VALUES (?, ?, ?, ?, ?)"
+
+_notice_queue = queue.Queue()
+_notice_worker = None
+_notice_worker_lock = threading.Lock()
+
+
+def _queue_batches(q):
+    # Yields what arrived within NOTICE_FLUSH_MS (up to NOTICE_BATCH_SIZE items) until a None sentinel.
+    running = True
+    while running:
+        batch = [q.get()]
+        deadline = time.monotonic() + NOTICE_FLUSH_MS / 1000
+        while len(batch) < NOTICE_BATCH_SIZE:
+            try:
+                batch.append(q.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        items = [item for item in batch if item is not None]
+        running = len(items) == len(batch)
+        try:
+            if items:
+                yield items
+        finally:
+            for _ in batch:
+                q.task_done()
+
+
+def _notice_writer():
+    conn = get_db_connection()
+    for rows in _queue_batches(_notice_queue):
+        try:
+            conn.executemany(INSERT_NOTICE_SQL, rows)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            app.logger.exception("Failed to write %d notices", len(rows))
     conn.close()
 
 
-def current_user():
-    uid = session.get("user_id")
-    if not uid:
+def _ensure_notice_worker():
+    global _notice_worker
+    with _notice_worker_lock:
+        if _notice_worker is None or not _notice_worker.is_alive():
+            _notice_worker = threading.Thread(target=_notice_writer, name="notice-writer", daemon=True)
+            _notice_worker.start()
+
+
+@atexit.register
+def _stop_notice_worker():
+    if _notice_worker is not None and _notice_worker.is_alive():
+        _notice_queue.put(None)
+        _notice_worker.join(timeout=10)
+
+
+def add_notice(title: str, text: str, sender: str, recipient: str, commit: bool = True):
+    # commit=False: insert as part of the caller's open transaction on the request connection.
+    row = (now_ts(), title, text, sender, recipient)
+    if not commit:
+        get_db().execute(INSERT_NOTICE_SQL, row)
+    elif NOTICES_ASYNC and not app.testing:
+        _ensure_notice_worker()
+        _notice_queue.put(row)
+    else:
+        conn = get_db()
+        conn.execute(INSERT_NOTICE_SQL, row)
+        conn.commit()
+
+
+def add_notices(notices, commit: bool = True):
+    """add_notice for many (title, text, sender, recipient) tuples at once."""
+    ts = now_ts()
+    rows = [(ts, *n) for n in notices]
+    if not rows:
+        return
+    if not commit:
+        get_db().executemany(INSERT_NOTICE_SQL, rows)
+    elif NOTICES_ASYNC and not app.testing:
+        _ensure_notice_worker()
+        for row in rows:
+            _notice_queue.put(row)
+    else:
+        conn = get_db()
+        conn.executemany(INSERT_NOTICE_SQL, rows)
+        conn.commit()
+
+
+# Server-side sessions: the cookie carries only a random session id. Each session keeps a
+# snapshot of its users row (without the password), so authorization needs no users lookup.
+# Sessions live in an in-memory LRU and in the sessions table, which lets them survive
+# restarts; routine updates (sliding expiry, refreshed profiles) are written by a background thread.
+_sessions = OrderedDict()  # sid -> {"uid", "profile", "loaded", "expires", "touched"}
+_user_sessions = defaultdict(set)  # uid -> sids held in memory
+_sessions_lock = threading.Lock()
+_session_queue = queue.Queue()
+_session_worker = None
+_session_worker_lock = threading.Lock()
+
+
+def _session_writer():
+    conn = get_db_connection()
+    for ops in _queue_batches(_session_queue):
+        try:
+            for sql, params in ops:
+                conn.execute(sql, params)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            app.logger.exception("Failed to write %d session updates", len(ops))
+    conn.close()
+
+
+def session_write(sql: str, params=()):
+    global _session_worker
+    if SESSIONS_ASYNC and not app.testing:
+        with _session_worker_lock:
+            if _session_worker is None or not _session_worker.is_alive():
+                _session_worker = threading.Thread(target=_session_writer, name="session-writer", daemon=True)
+                _session_worker.start()
+        _session_queue.put((sql, params))
+    else:
+        # Joins the request's open transaction if there is one, so it commits or rolls back with it.
+        conn = get_db()
+        owned = not conn.in_transaction
+        conn.execute(sql, params)
+        if owned:
+            conn.commit()
+
+
+@atexit.register
+def _stop_session_worker():
+    if _session_worker is not None and _session_worker.is_alive():
+        _session_queue.put(None)
+        _session_worker.join(timeout=10)
+
+
+def user_profile_snapshot(row) -> dict:
+    return {k: row[k] for k in row.keys() if k != "password"}
+
+
+def _session_remember(sid: str, uid: int, profile, expires: float, touched: float):
+    # Caller holds _sessions_lock.
+    _sessions[sid] = {"uid": uid, "profile": profile, "loaded": time.monotonic(),
+                      "expires": expires, "touched": touched}
+    _sessions.move_to_end(sid)
+    _user_sessions[uid].add(sid)
+    while len(_sessions) > SESSION_CACHE_SIZE:
+        old_sid, old = _sessions.popitem(last=False)
+        _session_forget(old_sid, old["uid"])
+
+
+def _session_forget(sid: str, uid: int):
+    sids = _user_sessions.get(uid)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del _user_sessions[uid]
+
+
+def create_session(user) -> str:
+    sid = secrets.token_urlsafe(32)
+    now = time.time()
+    profile = user_profile_snapshot(user)
+    conn = get_db()
+    conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+    conn.execute("INSERT INTO sessions(id, user_id, profile, created_ts, expires) VALUES(?,?,?,?,?)",
+                 (sid, user["id"], json.dumps(profile, ensure_ascii=False), now_ts(), now + SESSION_TTL))
+    conn.commit()
+    with _sessions_lock:
+        _session_remember(sid, user["id"], profile, now + SESSION_TTL, now)
+    return sid
+
+
+def end_session(sid: str):
+    with _sessions_lock:
+        entry = _sessions.pop(sid, None)
+        if entry:
+            _session_forget(sid, entry["uid"])
+    session_write("DELETE FROM sessions WHERE id = ?", (sid,))
+
+
+def revoke_sessions(conn, uid: int):
+    # Runs inside the caller's transaction, so the revocation commits with the change that caused it.
+    with _sessions_lock:
+        for sid in _user_sessions.pop(uid, ()):
+            _sessions.pop(sid, None)
+    conn.execute("DELETE FROM sessions WHERE user_id = ?", (uid,))
+
+
+def load_session(sid: str):
+    """Profile for session ``sid``, or None when it is unknown, expired or revoked."""
+    now = time.time()
+    # A primary-key read on every request: a revocation (row deleted) or a profile reset
+    # (profile NULL) made by any process is seen at once; the cache only skips re-reading users.
+    row = get_db().execute("SELECT user_id, profile, expires FROM sessions WHERE id = ?", (sid,)).fetchone()
+    with _sessions_lock:
+        entry = _sessions.get(sid)
+        if entry is not None:
+            _sessions.move_to_end(sid)
+    if not row:
+        if entry is not None:
+            end_session(sid)
+        return None
+    if entry is None:
+        entry = {"uid": row["user_id"], "profile": json.loads(row["profile"]) if row["profile"] else None,
+                 "expires": row["expires"], "touched": row["expires"] - SESSION_TTL}
+        with _sessions_lock:
+            _session_remember(sid, entry["uid"], entry["profile"], entry["expires"], entry["touched"])
+            entry = _sessions[sid]
+    if entry["expires"] < now:
+        end_session(sid)
         return None
+
+    profile = entry["profile"]
+    if profile is None or row["profile"] is None or time.monotonic() - entry["loaded"] > SESSION_PROFILE_TTL:
+        user = get_db().execute("SELECT * FROM users WHERE id = ?", (entry["uid"],)).fetchone()
+        if not user:
+            end_session(sid)
+            return None
+        profile = user_profile_snapshot(user)
+        entry.update(profile=profile, loaded=time.monotonic())
+        session_write("UPDATE sessions SET profile = ? WHERE id = ?", (json.dumps(profile, ensure_ascii=False), sid))
+    if now - entry["touched"] > SESSION_TOUCH_INTERVAL:
+        entry.update(touched=now, expires=now + SESSION_TTL)
+        session_write("UPDATE sessions SET expires = ? WHERE id = ?", (entry["expires"], sid))
+    return profile
+
+
+# Live feed hub: one poller thread reads new notices for every SSE subscriber.
+NOTICE_PUBLIC_RECIPIENTS = ("all", "students", "cook", "admin")
+
+_live_subscribers = set()
+_live_lock = threading.Lock()
+_live_poller = [None]
+
+
+def live_publish(event: str, data: dict):
+    with _live_lock:
+        subscribers = list(_live_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait((event, data))
+        except queue.Full:
+            live_unsubscribe(q)
+            q.queue.clear()
+            q.put_nowait((None, None))
+
+
+def live_subscribe():
+    q = queue.Queue(maxsize=200)
+    with _live_lock:
+        _live_subscribers.add(q)
+        if _live_poller[0] is None:
+            last_id = get_db().execute("SELECT IFNULL(MAX(id),0) FROM notices").fetchone()[0]
+            _live_poller[0] = threading.Thread(target=_poll_live_notices, args=(last_id,),
+                                               name="live-poller", daemon=True)
+            _live_poller[0].start()
+    return q
+
+
+def live_unsubscribe(q):
+    with _live_lock:
+        _live_subscribers.discard(q)
+
+
+def _poll_live_notices(last_id: int):
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
+    while True:
+        with _live_lock:
+            if not _live_subscribers:
+                _live_poller[0] = None
+                break
+        for r in conn.execute("SELECT * FROM notices WHERE id > ? ORDER BY id LIMIT 500", (last_id,)).fetchall():
+            last_id = r["id"]
+            live_publish("notice", {k: r[k] for k in ("id", "ts", "title", "text", "sender", "recipient")})
+        time.sleep(LIVE_POLL_INTERVAL)
     conn.close()
+
+
+def live_visible(event: str, data: dict, user: dict) -> bool:
+    if user["role"] == "admin":
+        return True
+    if event == "notice":
+        return data["recipient"] == user["login"] or data["recipient"] in NOTICE_PUBLIC_RECIPIENTS
+    if event == "order":
+        return user["role"] == "cook" or data["student_id"] == user["id"]
+    return False
+
+
+def current_user():
+    if "user" in g:
+        return g.user
+    sid = session.get("sid")
+    user = load_session(sid) if sid else None
+    g.user = user
     return user
 
 
+def forget_user(uid: int):
+    # The users row changed (balance, subscription...): sessions reload their snapshot on next use.
+    with _sessions_lock:
+        for sid in _user_sessions.get(uid, ()):
+            _sessions[sid]["profile"] = None
+    session_write("UPDATE sessions SET profile = NULL WHERE user_id = ?", (uid,))
+    if g.get("user") is not None and g.user["id"] == uid:
+        g.pop("user")
+
+
 def login_required(fn):
     @wraps(fn)
     def w(*args, **kwargs):
@@ -228,15 +976,15 @@ def seed_if_empty():
     if has_users == 0:
         cur.execute(
             "INSERT INTO users(role, login, password, name, work, balance) VALUES(?,?,?,?,?,?)",
-            ("admin", "admin", "admin", "Администратор", "завуч", 0)
+            ("admin", "admin", passwords.hash_password("admin"), "Администратор", "завуч", 0)
         )
         cur.execute(
             "INSERT INTO users(role, login, password, name, work, balance) VALUES(?,?,?,?,?,?)",
-            ("cook", "cook", "cook", "Повар", "столовая", 0)
+            ("cook", "cook", passwords.hash_password("cook"), "Повар", "столовая", 0)
         )
         cur.execute(
             "INSERT INTO users(role, login, password, name, work, balance) VALUES(?,?,?,?,?,?)",
-            ("student", "student", "student", "Ученик", "7Б", 500)
+            ("student", "student", passwords.hash_password("student"), "Ученик", "7Б", 500)
         )
         conn.commit()
 
@@ -250,16 +998,19 @@ def seed_if_empty():
         if not exists:
             cur.execute(
                 "INSERT INTO users(role, login, password, name, work, balance) VALUES(?,?,?,?,?,?)",
-                (role, login, password, name, work, balance)
+                (role, login, passwords.hash_password(password), name, work, balance)
             )
             conn.commit()
+    # Seeded balances have no top-up behind them; record them as opening balances.
+    seeded = json.dumps([v[0] for v in need.values()])
+    open_balance_checkpoints(conn, """u.login IN (SELECT value FROM json_each(?))
+        AND NOT EXISTS (SELECT 1 FROM balance_checkpoints c WHERE c.student_id = u.id)""", (seeded,))
+    conn.commit()
 
-    has_menu_today = cur.execute(
-        "SELECT COUNT(*) AS c FROM menu_items WHERE menu_date = ?",
-        (today_str(),)
-    ).fetchone()["c"]
+    # Demo dishes only for a brand-new database; real days come from the menu planner.
+    has_menu = cur.execute("SELECT EXISTS(SELECT 1 FROM menu_items) AS c").fetchone()["c"]
 
-    if has_menu_today == 0:
+    if not has_menu:
         items = [
             ("Каша овсяная", "завтрак", 80, 250, "молоко", 30),
             ("Суп куриный", "обед", 120, 300, "", 40),
@@ -272,25 +1023,156 @@ def seed_if_empty():
                 INSERT INTO menu_items(menu_date, name, meal_type, price, kcal, allergens, portions_total, portions_available)
                 VALUES(?,?,?,?,?,?,?,?)
             """, (today_str(), name, meal_type, price, kcal, allergens or None, portions, portions))
+            ledger_add(conn, today_str(), name, total=portions)
         conn.commit()
 
     conn.close()
 
 
+# users.active_until, cached for the current day: student id -> last valid date or None.
+_subscription_cache = {"day": None, "expires": 0.0, "until": {}}
+_subscription_lock = threading.Lock()
+_subscription_sweeper = None
+
+
+def active_until_map(conn, student_ids) -> dict:
+    today = date.today()
+    with _subscription_lock:
+        if _subscription_cache["day"] != today or _subscription_cache["expires"] < time.monotonic():
+            _subscription_cache.update(day=today, expires=time.monotonic() + SUBSCRIPTION_CACHE_TTL, until={})
+        cache = _subscription_cache["until"]
+        missing = [sid for sid in student_ids if sid not in cache]
+    if missing:
+        found = dict(conn.execute("SELECT id, active_until FROM users WHERE id IN (SELECT value FROM json_each(?))",
+                                  (json.dumps(missing),)).fetchall())
+        with _subscription_lock:
+            for sid in missing:
+                until = date.fromisoformat(found[sid]) if found.get(sid) else None
+                cache[sid] = until if until and until >= today else None
+    return {sid: cache.get(sid) for sid in student_ids}
+
+
+def remember_subscription(student_id: int, until):
+    with _subscription_lock:
+        if _subscription_cache["day"] == date.today():
+            _subscription_cache["until"][student_id] = until
+
+
+def forget_subscriptions(student_ids):
+    with _subscription_lock:
+        for sid in student_ids:
+            _subscription_cache["until"].pop(sid, None)
+
+
 def get_active_subscription(conn, student_id: int):
-    row = conn.execute(
-        "SELECT * FROM subscriptions WHERE student_id = ? ORDER BY until_date DESC LIMIT 1",
-        (student_id,)
-    ).fetchone()
-    if not row:
+    until = active_until_map(conn, [student_id])[student_id]
+    if until is None:
         return None
+    return {"until": until.isoformat(), "days_left": (until - date.today()).days}
+
+
+def sweep_subscriptions(conn, today: date = None):
+    """Expire ended subscriptions and warn students whose subscription ends soon, in one transaction."""
+    today = today or date.today()
+    ts = now_ts()
+    # Every worker runs a sweeper; the write lock plus the rowcount checks below make sure
+    # only the sweeper that actually records a reminder or clears a row sends its notice.
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        until = date.fromisoformat(row["until_date"])
+        expiring = conn.execute("""
+            SELECT id, login, active_until FROM users
+            WHERE active_until >= ? AND active_until <= ?
+              AND NOT EXISTS (SELECT 1 FROM subscription_reminders r
+                              WHERE r.student_id = users.id AND r.until_date = users.active_until)
+        """, (today.isoformat(), (today + timedelta(days=SUBSCRIPTION_NOTICE_DAYS)).isoformat())).fetchall()
+        expired = conn.execute("SELECT id, login, active_until FROM users WHERE active_until < ?",
+                               (today.isoformat(),)).fetchall()
+
+        expiring = [r for r in expiring if conn.execute(
+            "INSERT OR IGNORE INTO subscription_reminders(student_id, until_date) VALUES(?,?)",
+            (r["id"], r["active_until"])).rowcount]
+        expired = [r for r in expired if conn.execute(
+            "UPDATE users SET active_until = NULL WHERE id = ? AND active_until = ?",
+            (r["id"], r["active_until"])).rowcount]
+        conn.executemany(INSERT_NOTICE_SQL, [
+            (ts, "Абонемент заканчивается", f"Абонемент действует до {r['active_until']}.", "Система", r["login"])
+            for r in expiring
+        ] + [
+            (ts, "Абонемент закончился", f"Абонемент закончился {r['active_until']}.", "Система", r["login"])
+            for r in expired
+        ])
+        conn.execute("DELETE FROM subscription_reminders WHERE until_date < ?", (today.isoformat(),))
+        conn.commit()
     except Exception:
-        return None
-    if until < date.today():
-        return None
-    return row
+        conn.rollback()
+        raise
+
+    forget_subscriptions([r["id"] for r in expired])
+    for r in expired:
+        forget_user(r["id"])
+    return len(expiring), len(expired)
+
+
+def _subscription_sweep_loop():
+    while True:
+        try:
+            with app.app_context():
+                conn = get_db_connection()
+                try:
+                    sweep_subscriptions(conn)
+                finally:
+                    conn.close()
+        except Exception:
+            app.logger.exception("Subscription sweep failed")
+        time.sleep(SUBSCRIPTION_SWEEP_INTERVAL)
+
+
+@app.before_request
+def ensure_subscription_sweeper():
+    global _subscription_sweeper
+    if app.testing or (_subscription_sweeper is not None and _subscription_sweeper.is_alive()):
+        return
+    with _subscription_lock:
+        if _subscription_sweeper is None or not _subscription_sweeper.is_alive():
+            _subscription_sweeper = threading.Thread(target=_subscription_sweep_loop,
+                                                     name="subscription-sweeper", daemon=True)
+            _subscription_sweeper.start()
+
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+
+def page_args():
+    before = request.args.get("before", "").strip()
+    size = request.args.get("size", "")
+    size = int(size) if size.isdigit() and int(size) > 0 else PAGE_SIZE_DEFAULT
+    return before, min(size, PAGE_SIZE_MAX)
+
+
+def make_pager(next_before):
+    args = request.args.to_dict()
+    args.update(request.view_args or {})
+    pager = {"next_url": None, "first_url": None}
+    if next_before is not None:
+        pager["next_url"] = url_for(request.endpoint, **{**args, "before": next_before})
+    if args.pop("before", None):
+        pager["first_url"] = url_for(request.endpoint, **args)
+    return pager
+
+
+def fetch_page(conn, sql, conditions, params, id_col="id"):
+    # Keyset pagination, newest first: ?before=<id> continues below the last id shown.
+    before, size = page_args()
+    conditions, params = list(conditions), list(params)
+    if before.isdigit():
+        conditions.append(f"{id_col} < ?")
+        params.append(int(before))
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    rows = conn.execute(f"{sql} ORDER BY {id_col} DESC LIMIT ?", params + [size + 1]).fetchall()
+    next_before = rows[size - 1][id_col.split(".")[-1]] if len(rows) > size else None
+    return rows[:size], make_pager(next_before)
+
 
 ORDER_STATUS_RU = {
     "new": "Новая",
@@ -305,10 +1187,64 @@ COMPLAINT_STATUS_RU = {
     "rejected": "Отклонена",
 }
 MEAL_RU = {"breakfast": "Завтрак", "lunch": "Обед", "snack": "Полдник"}
+MEAL_KEYS = {
+    "breakfast": "breakfast", "завтрак": "breakfast",
+    "lunch": "lunch", "обед": "lunch",
+    "snack": "snack", "полдник": "snack", "закуска": "snack",
+}
+
+
+def find_cached_report(conn, date_from: str, date_to: str, granularity: str, fmt: str, version: str):
+    """A finished or in-flight report for the same period and type built from the same data, if any."""
+    for row in conn.execute("""
+        SELECT id, status, filename FROM reports
+        WHERE period_from=? AND period_to=? AND granularity=? AND fmt=? AND data_version=?
+          AND status IN ('queued', 'running', 'done')
+        ORDER BY id DESC
+    """, (date_from, date_to, granularity, fmt, version)):
+        if row["status"] != "done" or os.path.exists(os.path.join(REPORTS_DIR, row["filename"])):
+            return row
+    return None
+
+
+def report_owner() -> str:
+    # Read per call: under a pre-forking server each worker has its own pid and pool.
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        return False  # no signal-0 probe there; a Windows server runs a single process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def fail_interrupted_reports():
+    # A job lives only in the pool of the process that queued it, so it is cut off when that
+    # process is gone; jobs of live workers (and of other hosts sharing the file) are left alone.
+    conn = get_db_connection()
+    host = socket.gethostname()
+    stale = []
+    for r in conn.execute("SELECT id, owner FROM reports WHERE status IN ('queued', 'running')"):
+        owner_host, _, pid = (r["owner"] or "").rpartition(":")
+        if not r["owner"] or (owner_host == host and (not pid.isdigit() or not pid_alive(int(pid)))):
+            stale.append((now_ts(), r["id"]))
+    conn.executemany("""
+        UPDATE reports SET status='failed', error='Прервано перезапуском сервера', finished_ts=?
+        WHERE id=? AND status IN ('queued', 'running')
+    """, stale)
+    conn.commit()
+    conn.close()
 
 
 init_db()
 seed_if_empty()
+fail_interrupted_reports()
 
 @app.route("/")
 def root():
@@ -321,13 +1257,32 @@ def login():
         login_ = request.form.get("login", "").strip()
         password = request.form.get("password", "").strip()
 
-        conn = get_db_connection()
+        conn = get_db()
         u = conn.execute("SELECT * FROM users WHERE login = ?", (login_,)).fetchone()
-        conn.close()
 
-        if not u or u["password"] != password:
-            return render_template("login.html", error="Неверный логин или пароль.")
-        session["user_id"] = u["id"]
+        try:
+            if not u:
+                passwords.check(None, passwords.dummy_hash(), password)
+                return render_template("login.html", error="Неверный логин или пароль.")
+            if not passwords.check(u["id"], u["password"], password):
+                return render_template("login.html", error="Неверный логин или пароль.")
+        except FutureTimeout:
+            return render_template("login.html", error="Сервер перегружен, попробуйте войти ещё раз.")
+
+        # Legacy plain-text rows and hashes made with an older METHOD are upgraded on login,
+        # unless the pool is busy: the upgrade then waits for a later login.
+        rehashed = None
+        if passwords.needs_rehash(u["password"]):
+            try:
+                rehashed = passwords.run(passwords.hash_password, password, timeout=passwords.REHASH_TIMEOUT)
+            except FutureTimeout:
+                pass
+        if rehashed:
+            conn.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                         (rehashed, u["id"], u["password"]))
+            conn.commit()
+        session.clear()
+        session["sid"] = create_session(u)
         return redirect("/dashboard")
 
     return render_template("login.html")
@@ -335,6 +1290,8 @@ def login():
 
 @app.route("/logout")
 def logout():
+    if session.get("sid"):
+        end_session(session["sid"])
     session.clear()
     return redirect("/login")
 
@@ -362,17 +1319,20 @@ def register():
         if code and code != codes[role]:
             return render_template("register.html", error="Неверный код регистрации.")
 
-        conn = get_db_connection()
+        try:
+            hashed = passwords.run(passwords.hash_password, p1)
+        except FutureTimeout:
+            return render_template("register.html", error="Сервер перегружен, попробуйте ещё раз.")
+
+        conn = get_db()
         try:
             conn.execute(
                 "INSERT INTO users(role, login, password, name, work) VALUES(?,?,?,?,?)",
-                (role, login_, p1, name, work)
+                (role, login_, hashed, name, work)
             )
             conn.commit()
         except sqlite3.IntegrityError:
-            conn.close()
             return render_template("register.html", error="Такой логин уже занят.")
-        conn.close()
 
         add_notice("Новый пользователь", f"{name} ({role}), {work}", "Система", "admin")
         return redirect("/login")
@@ -380,59 +1340,39 @@ def register():
     return render_template("register.html")
 
 
-@app.route("/dashboard")
-@login_required
-def dashboard():
-    u = current_user()
-    conn = get_db_connection()
+DASHBOARD_CACHE_TTL = 5  # seconds
+_dashboard_cache = {"day": None, "expires": 0.0, "data": None}
+_dashboard_gen = [0]
+_dashboard_lock = threading.Lock()
 
-    menu_today = conn.execute(
-        "SELECT COUNT(*) AS c FROM menu_items WHERE menu_date = ?",
-        (today_str(),)
-    ).fetchone()["c"]
 
-    serves_today = conn.execute(
-        "SELECT IFNULL(SUM(count),0) AS c FROM serves WHERE substr(ts,1,10)=?",
-        (today_str(),)
-    ).fetchone()["c"]
+def invalidate_dashboard():
+    _dashboard_gen[0] += 1
+    _dashboard_cache["expires"] = 0.0
 
-    writeoff_today = conn.execute(
-        "SELECT IFNULL(SUM(count),0) AS c FROM writeoffs WHERE substr(ts,1,10)=?",
-        (today_str(),)
-    ).fetchone()["c"]
 
-    orders_new = conn.execute("SELECT COUNT(*) AS c FROM orders WHERE status='new'").fetchone()["c"]
-    orders_approved = conn.execute("SELECT COUNT(*) AS c FROM orders WHERE status='approved'").fetchone()["c"]
+def load_dashboard_data(conn, day: str):
+    start, end = day_range(day)
+    row = conn.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM menu_items WHERE menu_date = :day) AS menu_today,
+            (SELECT IFNULL(SUM(count),0) FROM serves WHERE ts >= :start AND ts < :end) AS serves_today,
+            (SELECT IFNULL(SUM(count),0) FROM writeoffs WHERE ts >= :start AND ts < :end) AS writeoff_today,
+            (SELECT COUNT(*) FROM orders WHERE status='new') AS orders_new,
+            (SELECT COUNT(*) FROM orders WHERE status='approved') AS orders_approved
+    """, {"day": day, "start": start, "end": end}).fetchone()
 
     notices = conn.execute("SELECT * FROM notices ORDER BY id DESC LIMIT 8").fetchall()
 
     top_stock_rows = conn.execute("""
-        SELECT name, SUM(portions_available) AS available
-        FROM menu_items
-        WHERE menu_date = ?
-        GROUP BY name
+        SELECT item AS name, available
+        FROM stock_ledger
+        WHERE day = ?
         ORDER BY available DESC
         LIMIT 6
-    """, (today_str(),)).fetchall()
+    """, (day,)).fetchall()
 
-    balance = None
-    subscription = None
-    if u["role"] == "student":
-        balance = u["balance"]
-        sub = get_active_subscription(conn, u["id"])
-        if sub:
-            until = date.fromisoformat(sub["until_date"])
-            subscription = {"until": sub["until_date"], "days_left": (until - date.today()).days}
-
-    conn.close()
-
-    stats = {
-        "menu_today": int(menu_today),
-        "serves_today": int(serves_today),
-        "writeoff_today": int(writeoff_today),
-        "orders_new": int(orders_new),
-        "orders_approved": int(orders_approved),
-    }
+    stats = {k: int(row[k]) for k in row.keys()}
 
     feed = [{
         "ts": n["ts"],
@@ -443,26 +1383,209 @@ def dashboard():
     } for n in notices]
 
     top_stock = [{"name": r["name"], "available": int(r["available"] or 0)} for r in top_stock_rows]
+    return {"stats": stats, "feed": feed, "top_stock": top_stock}
+
+
+def get_dashboard_data(conn):
+    day = today_str()
+    cache = _dashboard_cache
+    if cache["day"] == day and cache["expires"] > time.monotonic():
+        return cache["data"]
+    with _dashboard_lock:
+        if cache["day"] == day and cache["expires"] > time.monotonic():
+            return cache["data"]
+        gen = _dashboard_gen[0]
+        data = load_dashboard_data(conn, day)
+        if gen == _dashboard_gen[0]:
+            cache.update(day=day, expires=time.monotonic() + DASHBOARD_CACHE_TTL, data=data)
+        return data
+
+
+@app.route("/dashboard")
+@login_required
+def dashboard():
+    u = current_user()
+    conn = get_db()
+    data = get_dashboard_data(conn)
+
+    balance = None
+    subscription = None
+    if u["role"] == "student":
+        balance = u["balance"]
+        subscription = get_active_subscription(conn, u["id"])
 
     return render_template(
         "dashboard.html",
         user=u,
-        stats=stats,
-        feed=feed,
-        top_stock=top_stock,
+        stats=data["stats"],
+        feed=data["feed"],
+        top_stock=data["top_stock"],
         balance=balance,
         subscription=subscription
     )
 
+# Canonical allergens: code -> (label, word stems that name it in free text; "ё" written as "е").
+# A stem matches the start of a word; a stem ending in "$" must be the whole word, for short
+# roots that begin unrelated words ("nut" in "nutmeg", "мед" in "медальон").
+ALLERGENS = {
+    "gluten": ("Глютен", ("глютен", "пшени", "рожь", "ржан", "ячмен", "мука$", "муки$", "мукой$", "мучн",
+                          "gluten", "wheat")),
+    "milk": ("Молоко", ("молок", "молочн", "лактоз", "сливк", "сыр$", "сыра$", "сыром$", "сыры$", "сырн", "сырк",
+                        "творог", "кефир", "milk", "lactose", "dairy")),
+    "eggs": ("Яйца", ("яйц", "яичн", "egg$", "eggs$")),
+    "nuts": ("Орехи", ("орех", "миндал", "фундук", "кешью", "фисташ", "nut$", "nuts$")),
+    "peanuts": ("Арахис", ("арахис", "peanut")),
+    "fish": ("Рыба", ("рыба$", "рыбы$", "рыбой$", "рыбн", "рыбий", "рыбь", "fish")),
+    "shellfish": ("Морепродукты", ("морепродукт", "креветк", "краб", "моллюск", "кальмар", "мидии", "shellfish")),
+    "soy": ("Соя", ("соя$", "сои$", "соей$", "соев", "soy$", "soya$")),
+    "sesame": ("Кунжут", ("кунжут", "sesame")),
+    "celery": ("Сельдерей", ("сельдере", "celery")),
+    "mustard": ("Горчица", ("горчиц", "mustard")),
+    "sulfites": ("Сульфиты", ("сульфит", "sulfite", "sulphite")),
+    "honey": ("Мёд", ("мед$", "меда$", "меду$", "медом$", "медов", "honey")),
+    "citrus": ("Цитрусовые", ("цитрус", "апельсин", "лимон", "мандарин", "citrus")),
+}
+ALLERGEN_STOPWORDS = {"без", "нет", "следы", "содержит", "может", "аллергия", "на", "и"}
+CONFLICT_MAP_TTL = 60  # seconds; menu and roster changes here rebuild it at once
+
+
+def _stem_matches(word: str, stem: str) -> bool:
+    return word == stem[:-1] if stem.endswith("$") else word.startswith(stem)
+
+
+@lru_cache(maxsize=4096)
+def allergen_codes(text) -> frozenset:
+    """Normalize a free-text allergen list to canonical codes.
+
+    Each comma/semicolon separated entry maps to the allergens its words name; an entry naming
+    none of them is kept whole as "~entry", so uncommon allergens still match each other.
+    """
+    codes = set()
+    for entry in re.split(r"[,;/\n]+", (text or "").lower().replace("ё", "е")):
+        words = [w for w in re.findall(r"\w+", entry) if w not in ALLERGEN_STOPWORDS and not w.isdigit()]
+        found = {code for code, (_, stems) in ALLERGENS.items()
+                 if any(_stem_matches(w, stem) for w in words for stem in stems)}
+        if found:
+            codes |= found
+        elif words:
+            codes.add("~" + " ".join(words))
+    return frozenset(codes)
+
+
+def allergen_labels(codes) -> str:
+    return ", ".join(sorted(ALLERGENS[c][0] if c in ALLERGENS else c[1:] for c in codes))
+
+
+_conflicts = {"day": None, "gen": -1, "expires": 0.0, "map": {}}
+_conflicts_gen = [0]
+
+
+def invalidate_conflicts():
+    _conflicts_gen[0] += 1
+
+
+def get_conflict_map(conn):
+    """{student_id: {menu_item_id: allergen codes}} for today's menu, built once per day or menu change."""
+    day, gen = today_str(), _conflicts_gen[0]
+    cache = _conflicts
+    if cache["day"] == day and cache["gen"] == gen and cache["expires"] > time.monotonic():
+        return cache["map"]
+    menu_codes = [(r["id"], allergen_codes(r["allergens"])) for r in conn.execute(
+        "SELECT id, allergens FROM menu_items WHERE menu_date=? AND IFNULL(allergens, '') != ''", (day,))]
+    menu_codes = [(item_id, codes) for item_id, codes in menu_codes if codes]
+    conflicts = {}
+    if menu_codes:
+        for r in conn.execute("SELECT id, allergy FROM users WHERE role='student' AND IFNULL(allergy, '') != ''"):
+            codes = allergen_codes(r["allergy"])
+            hits = {item_id: codes & item_codes for item_id, item_codes in menu_codes if codes & item_codes}
+            if hits:
+                conflicts[r["id"]] = hits
+    cache.update(day=day, gen=gen, expires=time.monotonic() + CONFLICT_MAP_TTL, map=conflicts)
+    return conflicts
+
+
+def allergy_conflict(conn, student, item, conflicts=None) -> frozenset:
+    # Serving paths pass a map fetched before BEGIN IMMEDIATE, so a rebuild never holds the write lock.
+    if item["menu_date"] == today_str():
+        conflicts = get_conflict_map(conn) if conflicts is None else conflicts
+        return conflicts.get(student["id"], {}).get(item["id"], frozenset())
+    return allergen_codes(student["allergy"]) & allergen_codes(item["allergens"])
+
+
+MENU_CACHE_TTL = 30  # seconds; bounds staleness across processes, writes here invalidate at once
+_menu_cache = {}
+_menu_gen = [0]
+_menu_lock = threading.Lock()
+
+
+def invalidate_menu():
+    with _menu_lock:
+        _menu_gen[0] += 1
+        _menu_cache.clear()
+
+
+def load_menu_snapshot(conn, day: str):
+    rows = conn.execute(
+        "SELECT * FROM menu_items WHERE menu_date = ? ORDER BY meal_type, name",
+        (day,)
+    ).fetchall()
+    items = [{
+        "id": r["id"],
+        "name": r["name"],
+        "meal_type": r["meal_type"],
+        "meal_ru": MEAL_RU.get(r["meal_type"], r["meal_type"]),
+        "price": r["price"],
+        "kcal": r["kcal"],
+        "allergens": r["allergens"],
+        "available": r["portions_available"],
+    } for r in rows]
+    counters = {str(m["id"]): m["available"] for m in items}
+    # Page validator covers everything but the live counters, which the page refreshes from /menu/counters.
+    dishes = [[v for k, v in m.items() if k != "available"] for m in items]
+    return {
+        "items": items,
+        "counters": counters,
+        "etag": hashlib.sha1(json.dumps([day, dishes], ensure_ascii=False).encode()).hexdigest()[:16],
+        "counters_etag": hashlib.sha1(json.dumps([day, counters]).encode()).hexdigest()[:16],
+    }
+
+
+def get_menu_snapshot(conn, day: str):
+    snap = _menu_cache.get(day)
+    if snap and snap["expires"] > time.monotonic():
+        return snap
+    with _menu_lock:
+        gen = _menu_gen[0]
+    snap = load_menu_snapshot(conn, day)
+    snap["expires"] = time.monotonic() + MENU_CACHE_TTL
+    with _menu_lock:
+        if gen == _menu_gen[0]:
+            _menu_cache[day] = snap
+    return snap
+
+
+@app.route("/menu/counters")
+@login_required
+def menu_counters():
+    day = parse_day(request.args.get("date"))
+    snap = get_menu_snapshot(get_db(), day)
+    if request.if_none_match.contains(snap["counters_etag"]):
+        resp = Response(status=304)
+    else:
+        resp = jsonify({"date": day, "available": snap["counters"]})
+    resp.set_etag(snap["counters_etag"])
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
 @app.route("/menu", methods=["GET", "POST"])
 @login_required
 def menu():
     u = current_user()
-    conn = get_db_connection()
+    conn = get_db()
 
     if request.method == "POST":
         if u["role"] not in ("cook", "admin"):
-            conn.close()
             return render_template("menu.html", user=u, error="Только повар/админ может менять меню.")
 
         name = request.form.get("name", "").strip()
@@ -471,46 +1594,67 @@ def menu():
         kcal = int(request.form.get("kcal", "0") or 0)
         portions = int(request.form.get("portions", "0") or 0)
         allergens = request.form.get("allergens", "").strip() or None
+        menu_date = parse_day(request.form.get("menu_date"))
 
         if not name:
-            conn.close()
-            return render_template("menu.html", user=u, error="Название блюда обязательно.")
+            return render_template("menu.html", user=u, day=menu_date, error="Название блюда обязательно.")
+        if menu_date < today_str():
+            return render_template("menu.html", user=u, day=menu_date, error="Нельзя менять меню прошедших дней.")
 
         conn.execute("""
             INSERT INTO menu_items(menu_date, name, meal_type, price, kcal, allergens, portions_total, portions_available)
             VALUES(?,?,?,?,?,?,?,?)
-        """, (today_str(), name, meal_type, max(price, 0), max(kcal, 0), allergens, max(portions, 0), max(portions, 0)))
+        """, (menu_date, name, meal_type, max(price, 0), max(kcal, 0), allergens, max(portions, 0), max(portions, 0)))
+        ledger_add(conn, menu_date, name, total=max(portions, 0))
         conn.commit()
-        add_notice("Меню обновлено", f"Добавлено: {name} ({MEAL_RU.get(meal_type, meal_type)}), порций: {portions}", u["name"], "admin")
-
-    rows = conn.execute(
-        "SELECT * FROM menu_items WHERE menu_date = ? ORDER BY meal_type, name",
-        (today_str(),)
-    ).fetchall()
-    conn.close()
-
-    menu_items = [{
-        "name": r["name"],
-        "meal_type": r["meal_type"],
-        "meal_ru": MEAL_RU.get(r["meal_type"], r["meal_type"]),
-        "price": r["price"],
-        "kcal": r["kcal"],
-        "allergens": r["allergens"],
-        "available": r["portions_available"],
-    } for r in rows]
+        invalidate_dashboard()
+        invalidate_menu()
+        invalidate_conflicts()
+        when = "" if menu_date == today_str() else f" на {menu_date}"
+        add_notice("Меню обновлено", f"Добавлено{when}: {name} ({MEAL_RU.get(meal_type, meal_type)}), порций: {portions}", u["name"], "admin")
+
+    day = parse_day(request.values.get("date") or request.form.get("menu_date"))
+    snap = get_menu_snapshot(conn, day)
+    if request.method == "POST":
+        return render_template("menu.html", user=u, menu_items=snap["items"], day=day)
 
-    return render_template("menu.html", user=u, menu_items=menu_items)
+    # The page differs per role and shows the user's name and allergy warnings, so the validator is per user.
+    etag = hashlib.sha1(f"{snap['etag']}|{u['id']}|{u['role']}|{u['name']}|{u['allergy']}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        warnings = {}
+        if u["role"] == "student" and u["allergy"]:
+            for m in snap["items"]:
+                conflict = allergy_conflict(conn, u, {**m, "menu_date": day})
+                if conflict:
+                    warnings[m["id"]] = allergen_labels(conflict)
+        resp = make_response(render_template("menu.html", user=u, menu_items=snap["items"], day=day,
+                                             allergy_warnings=warnings))
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @app.route("/menu/history")
 @login_required
 def menu_history():
     u = current_user()
-    conn = get_db_connection()
-    rows = conn.execute(
-        "SELECT * FROM menu_items ORDER BY menu_date DESC, meal_type, name LIMIT 200"
-    ).fetchall()
-    conn.close()
+    conn = get_db()
+    before, size = page_args()
+    day, _, last_id = before.partition(":")
+    if last_id.isdigit():
+        rows = conn.execute("""
+            SELECT * FROM menu_items
+            WHERE (menu_date, id) < (?, ?)
+            ORDER BY menu_date DESC, id DESC LIMIT ?
+        """, (day, int(last_id), size + 1)).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT * FROM menu_items ORDER BY menu_date DESC, id DESC LIMIT ?", (size + 1,)
+        ).fetchall()
+    next_before = f"{rows[size - 1]['menu_date']}:{rows[size - 1]['id']}" if len(rows) > size else None
+    rows = rows[:size]
 
     menu_items = [{
         "name": f"{r['name']} (дата: {r['menu_date']})",
@@ -522,75 +1666,252 @@ def menu_history():
         "available": r["portions_available"],
     } for r in rows]
 
-    return render_template("menu.html", user=u, menu_items=menu_items, message="История меню (последние записи).")
+    return render_template("menu.html", user=u, menu_items=menu_items, pager=make_pager(next_before),
+                           message="История меню (последние записи).")
+
+WEEKDAYS_RU = ("ПН", "ВТ", "СР", "ЧТ", "ПТ", "СБ", "ВС")
+
+
+def parse_day(value, default: str = None) -> str:
+    try:
+        return date.fromisoformat((value or "").strip()).isoformat()
+    except ValueError:
+        return default or today_str()
+
+
+def week_start(day: str) -> date:
+    d = date.fromisoformat(day)
+    return d - timedelta(days=d.weekday())
+
+
+def insert_menu_items(conn, rows) -> int:
+    """Bulk-insert (menu_date, name, meal_type, price, kcal, allergens, portions) rows in the caller's transaction.
+
+    Dishes already on the menu for the same date and meal are skipped; returns how many were added.
+    """
+    if not rows:
+        return 0
+    days = sorted({r[0] for r in rows})
+    existing = {(r["menu_date"], r["meal_type"], r["name"]) for r in conn.execute(
+        "SELECT menu_date, meal_type, name FROM menu_items WHERE menu_date >= ? AND menu_date <= ?", (days[0], days[-1]))}
+    fresh = []
+    for r in rows:
+        if (r[0], r[2], r[1]) not in existing:
+            existing.add((r[0], r[2], r[1]))
+            fresh.append(r)
+    conn.executemany("""
+        INSERT INTO menu_items(menu_date, name, meal_type, price, kcal, allergens, portions_total, portions_available)
+        VALUES(?,?,?,?,?,?,?,?)
+    """, [(d, name, meal, price, kcal, allergens, portions, portions)
+          for d, name, meal, price, kcal, allergens, portions in fresh])
+    conn.executemany(LEDGER_UPSERT_SQL, [(d, name, portions, 0, 0, portions)
+                                         for d, name, meal, price, kcal, allergens, portions in fresh])
+    return len(fresh)
+
+
+def parse_menu_lines(text: str, monday: date):
+    """Lines of "день; приём пищи; блюдо; цена; ккал; порций; аллергены" -> menu rows.
+
+    The day is a weekday abbreviation (ПН..ВС) within the planned week or an ISO date.
+    """
+    rows, errors = [], []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        parts = [p.strip() for p in line.split(";")]
+        parts += [""] * (7 - len(parts))
+        day, meal, name, price, kcal, portions, allergens = parts[:7]
+        if day.upper() in WEEKDAYS_RU:
+            day = (monday + timedelta(days=WEEKDAYS_RU.index(day.upper()))).isoformat()
+        else:
+            day = parse_day(day, default="-")
+        meal = MEAL_KEYS.get(meal.lower())
+        if day == "-" or not meal or not name or not all(v.isdigit() for v in (price or "0", kcal or "0", portions or "0")):
+            errors.append(f"Строка {line_no}: {line.strip()[:60]}")
+            continue
+        rows.append((day, name, meal, int(price or 0), int(kcal or 0), allergens or None, int(portions or 0)))
+    return rows, errors
+
+
+def render_plan_page(conn, u, monday: date, error=None, message=None):
+    sunday = monday + timedelta(days=6)
+    days = {(monday + timedelta(days=i)).isoformat(): [] for i in range(7)}
+    for r in conn.execute("""
+        SELECT menu_date, name, meal_type, price, portions_total FROM menu_items
+        WHERE menu_date >= ? AND menu_date <= ?
+        ORDER BY menu_date, meal_type, name
+    """, (monday.isoformat(), sunday.isoformat())):
+        days[r["menu_date"]].append({"name": r["name"], "meal_ru": MEAL_RU.get(meal_key(r["meal_type"]), r["meal_type"]),
+                                     "price": r["price"], "portions": r["portions_total"]})
+    templates = conn.execute("""
+        SELECT t.id, t.name, COUNT(i.template_id) AS items
+        FROM menu_templates t LEFT JOIN menu_template_items i ON i.template_id = t.id
+        GROUP BY t.id ORDER BY t.name
+    """).fetchall()
+    week = [{"date": d, "weekday": WEEKDAYS_RU[i], "dishes": dishes} for i, (d, dishes) in enumerate(days.items())]
+    return render_template("menu_plan.html", user=u, week=week, monday=monday.isoformat(),
+                           prev_week=(monday - timedelta(days=7)).isoformat(),
+                           next_week=(monday + timedelta(days=7)).isoformat(),
+                           templates=templates, error=error, message=message)
+
+
+def save_planned_menu(conn, u, monday: date, rows, what: str):
+    # Past days are never rewritten; everything else lands in one transaction.
+    today = today_str()
+    skipped = sum(1 for r in rows if r[0] < today)
+    added = insert_menu_items(conn, [r for r in rows if r[0] >= today])
+    conn.commit()
+    if added:
+        invalidate_dashboard()
+        invalidate_menu()
+        invalidate_conflicts()
+        add_notice("Меню запланировано", f"{what}: добавлено блюд — {added}", u["name"], "admin")
+    message = f"{what}: добавлено блюд — {added}."
+    if skipped:
+        message += f" Пропущено в прошедших днях: {skipped}."
+    return render_plan_page(conn, u, monday, message=message)
+
+
+@app.route("/menu/plan")
+@role_required("cook", "admin")
+def menu_plan():
+    return render_plan_page(get_db(), current_user(), week_start(parse_day(request.args.get("week"))))
+
+
+@app.route("/menu/plan/copy", methods=["POST"])
+@role_required("cook", "admin")
+def menu_plan_copy():
+    u = current_user()
+    conn = get_db()
+    span = 7 if request.form.get("span") == "week" else 1
+    src = parse_day(request.form.get("from"))
+    dst = parse_day(request.form.get("to"))
+    if span == 7:
+        src, dst = week_start(src).isoformat(), week_start(dst).isoformat()
+    shift = date.fromisoformat(dst) - date.fromisoformat(src)
+    if not shift.days:
+        return render_plan_page(conn, u, week_start(dst), error="Выберите другую дату назначения.")
+
+    src_end = (date.fromisoformat(src) + timedelta(days=span)).isoformat()
+    rows = [((date.fromisoformat(r["menu_date"]) + shift).isoformat(), r["name"], r["meal_type"], r["price"],
+             r["kcal"], r["allergens"], r["portions_total"])
+            for r in conn.execute("""
+                SELECT menu_date, name, meal_type, price, kcal, allergens, portions_total FROM menu_items
+                WHERE menu_date >= ? AND menu_date < ?
+            """, (src, src_end))]
+    what = f"Копия {'недели' if span == 7 else 'дня'} {src} → {dst}"
+    return save_planned_menu(conn, u, week_start(dst), rows, what)
+
+
+@app.route("/menu/plan/bulk", methods=["POST"])
+@role_required("cook", "admin")
+def menu_plan_bulk():
+    u = current_user()
+    conn = get_db()
+    monday = week_start(parse_day(request.form.get("week")))
+    rows, errors = parse_menu_lines(request.form.get("lines", ""), monday)
+    if errors:
+        return render_plan_page(conn, u, monday, error="Не удалось разобрать: " + "; ".join(errors[:5]))
+    if not rows:
+        return render_plan_page(conn, u, monday, error="Добавьте хотя бы одно блюдо.")
+    return save_planned_menu(conn, u, monday, rows, f"Неделя с {monday.isoformat()}")
+
+
+@app.route("/menu/templates", methods=["POST"])
+@role_required("cook", "admin")
+def menu_template_save():
+    u = current_user()
+    conn = get_db()
+    monday = week_start(parse_day(request.form.get("week")))
+    name = request.form.get("name", "").strip()
+    if not name:
+        return render_plan_page(conn, u, monday, error="Укажите название шаблона.")
+
+    items = conn.execute("""
+        SELECT menu_date, name, meal_type, price, kcal, allergens, portions_total FROM menu_items
+        WHERE menu_date >= ? AND menu_date <= ?
+    """, (monday.isoformat(), (monday + timedelta(days=6)).isoformat())).fetchall()
+    if not items:
+        return render_plan_page(conn, u, monday, error="На этой неделе нет блюд для шаблона.")
+
+    tid = conn.execute("INSERT INTO menu_templates(name, ts, staff_id) VALUES(?,?,?)", (name, now_ts(), u["id"])).lastrowid
+    conn.executemany("""
+        INSERT INTO menu_template_items(template_id, weekday, name, meal_type, price, kcal, allergens, portions)
+        VALUES(?,?,?,?,?,?,?,?)
+    """, [(tid, date.fromisoformat(r["menu_date"]).weekday(), r["name"], r["meal_type"], r["price"], r["kcal"],
+           r["allergens"], r["portions_total"]) for r in items])
+    conn.commit()
+    return render_plan_page(conn, u, monday, message=f"Шаблон «{name}» сохранён ({len(items)} блюд).")
+
+
+@app.route("/menu/templates/<int:tid>/apply", methods=["POST"])
+@role_required("cook", "admin")
+def menu_template_apply(tid: int):
+    u = current_user()
+    conn = get_db()
+    monday = week_start(parse_day(request.form.get("week")))
+    template = conn.execute("SELECT name FROM menu_templates WHERE id=?", (tid,)).fetchone()
+    if not template:
+        return render_plan_page(conn, u, monday, error="Шаблон не найден.")
+
+    rows = [((monday + timedelta(days=r["weekday"])).isoformat(), r["name"], r["meal_type"], r["price"], r["kcal"],
+             r["allergens"], r["portions"])
+            for r in conn.execute("SELECT * FROM menu_template_items WHERE template_id=?", (tid,))]
+    return save_planned_menu(conn, u, monday, rows, f"Шаблон «{template['name']}» на неделю с {monday.isoformat()}")
+
+
+@app.route("/menu/templates/<int:tid>/delete", methods=["POST"])
+@role_required("cook", "admin")
+def menu_template_delete(tid: int):
+    conn = get_db()
+    conn.execute("DELETE FROM menu_template_items WHERE template_id=?", (tid,))
+    conn.execute("DELETE FROM menu_templates WHERE id=?", (tid,))
+    conn.commit()
+    return redirect(url_for("menu_plan", week=request.form.get("week")))
+
 
 @app.route("/availability")
 @login_required
 def availability():
     u = current_user()
-    conn = get_db_connection()
-
-    served = conn.execute("""
-        SELECT item, SUM(count) AS c
-        FROM serves
-        WHERE substr(ts,1,10) = ?
-        GROUP BY item
-    """, (today_str(),)).fetchall()
-    served_map = {r["item"]: int(r["c"] or 0) for r in served}
-
-    woff = conn.execute("""
-        SELECT item, SUM(count) AS c
-        FROM writeoffs
-        WHERE substr(ts,1,10) = ?
-        GROUP BY item
-    """, (today_str(),)).fetchall()
-    woff_map = {r["item"]: int(r["c"] or 0) for r in woff}
+    conn = get_db()
 
-    menu_rows = conn.execute("""
-        SELECT name, SUM(portions_available) AS available
-        FROM menu_items
-        WHERE menu_date = ?
-        GROUP BY name
-        ORDER BY name
+    rows = conn.execute("""
+        SELECT item, available, served, written_off
+        FROM stock_ledger
+        WHERE day = ?
+        ORDER BY item
     """, (today_str(),)).fetchall()
-    conn.close()
 
-    stock = []
-    for r in menu_rows:
-        nm = r["name"]
-        stock.append({
-            "name": nm,
-            "available": int(r["available"] or 0),
-            "served": int(served_map.get(nm, 0)),
-            "writeoff": int(woff_map.get(nm, 0)),
-        })
+    stock = [{
+        "name": r["item"],
+        "available": r["available"],
+        "served": r["served"],
+        "writeoff": r["written_off"],
+    } for r in rows]
 
     return render_template("availability.html", user=u, stock=stock)
 @app.route("/orders")
 @login_required
 def orders():
-    u = current_user()
-    conn = get_db_connection()
-
-    if u["role"] in ("cook", "admin"):
-        rows = conn.execute("""
-            SELECT o.*, us.name AS student_name
-            FROM orders o
-            JOIN users us ON us.id = o.student_id
-            ORDER BY o.id DESC
-            LIMIT 200
-        """).fetchall()
-    else:
-        rows = conn.execute("""
-            SELECT o.*, us.name AS student_name
-            FROM orders o
-            JOIN users us ON us.id = o.student_id
-            WHERE o.student_id = ?
-            ORDER BY o.id DESC
-            LIMIT 200
-        """, (u["id"],)).fetchall()
-
-    conn.close()
+    return render_orders_page(get_db(), current_user())
+
+
+def render_orders_page(conn, u, error=None, message=None, results=None):
+    sql = """
+        SELECT o.*, us.name AS student_name
+        FROM orders o
+        JOIN users us ON us.id = o.student_id
+    """
+    status = request.args.get("status", "")
+    conditions, params = [], []
+    if status in ORDER_STATUS_RU:
+        conditions.append("o.status = ?")
+        params.append(status)
+    if u["role"] not in ("cook", "admin"):
+        conditions.append("o.student_id = ?")
+        params.append(u["id"])
+    rows, pager = fetch_page(conn, sql, conditions, params, "o.id")
 
     orders_list = [{
         "id": r["id"],
@@ -604,7 +1925,8 @@ def orders():
         "comment": r["comment"],
     } for r in rows]
 
-    return render_template("orders.html", user=u, orders=orders_list)
+    return render_template("orders.html", user=u, orders=orders_list, pager=pager, status=status,
+                           statuses=ORDER_STATUS_RU, error=error, message=message, results=results)
 
 
 @app.route("/orders/create", methods=["POST"])
@@ -619,56 +1941,216 @@ def orders_create():
     if not item or count <= 0:
         return redirect("/orders")
 
-    conn = get_db_connection()
-    conn.execute("""
+    conn = get_db()
+    # Orders are served from today's menu by name (see fulfil_orders), so check the dish it will match.
+    dishes = [m for m in conn.execute("SELECT * FROM menu_items WHERE menu_date = ?", (today_str(),))
+              if m["name"].lower() == item.lower()]
+    dish = next((m for m in dishes if meal_key(m["meal_type"]) == meal_key(meal_type)), dishes[0] if dishes else None)
+    conflict = allergy_conflict(conn, u, dish) if dish and u["role"] == "student" else frozenset()
+    if conflict and request.form.get("allergy_override") != "1":
+        return render_orders_page(conn, u, error=(
+            f"В блюде есть ваши аллергены: {allergen_labels(conflict)}. Если заказ согласован, "
+            f"отметьте «Заказать, несмотря на аллергию»."))
+
+    cur = conn.execute("""
         INSERT INTO orders(ts, student_id, meal_type, item, count, comment, status)
         VALUES(?,?,?,?,?,?, 'new')
     """, (now_ts(), u["id"], meal_type, item, count, comment))
     conn.commit()
-    conn.close()
+    invalidate_dashboard()
+    live_publish("order", {"id": cur.lastrowid, "student_id": u["id"], "status": "new",
+                           "status_ru": ORDER_STATUS_RU["new"], "item": item, "count": count})
 
     add_notice("Новая заявка", f"{u['name']} запросил: {item} x{count} ({MEAL_RU.get(meal_type, meal_type)})", u["name"], "admin")
     return redirect("/orders")
 
 
+# action -> (new status, statuses it may be applied to, notice title, verb, bulk summary)
+ORDER_ACTIONS = {
+    "approve": ("approved", ("new", "rejected"), "Заявка принята", "принята", "Принято заявок"),
+    "reject": ("rejected", ("new", "approved"), "Заявка отклонена", "отклонена", "Отклонено заявок"),
+}
+
+
+def publish_orders(rows, status: str):
+    for r in rows:
+        live_publish("order", {"id": r["id"], "student_id": r["student_id"], "status": status,
+                               "status_ru": ORDER_STATUS_RU[status], "item": r["item"], "count": r["count"]})
+
+
+def set_orders_status(conn, u, order_ids, action: str) -> list:
+    """Apply ``action`` to every listed order in a state that allows it; returns the changed orders."""
+    status, sources, title, verb, _ = ORDER_ACTIONS[action]
+    ids = json.dumps(list(order_ids))
+    marks = ",".join("?" * len(sources))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(f"""
+            SELECT o.id, o.student_id, o.item, o.count, us.login
+            FROM orders o JOIN users us ON us.id = o.student_id
+            WHERE o.id IN (SELECT value FROM json_each(?)) AND o.status IN ({marks})
+        """, (ids, *sources)).fetchall()
+        conn.execute(f"""
+            UPDATE orders SET status = ?
+            WHERE id IN (SELECT value FROM json_each(?)) AND status IN ({marks})
+        """, (status, ids, *sources))
+        add_notices([(title, f"Заявка #{r['id']} {verb}: {r['item']} x{r['count']}", u["name"], r["login"])
+                     for r in rows], commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if rows:
+        invalidate_dashboard()
+        publish_orders(rows, status)
+    return rows
+
+
 @app.route("/orders/<int:oid>/approve")
 @role_required("cook", "admin")
 def orders_approve(oid: int):
-    u = current_user()
-    conn = get_db_connection()
-    order = conn.execute("SELECT * FROM orders WHERE id = ?", (oid,)).fetchone()
-    if not order:
-        conn.close()
-        return redirect("/orders")
-
-    conn.execute("UPDATE orders SET status='approved' WHERE id = ?", (oid,))
-    student = conn.execute("SELECT * FROM users WHERE id = ?", (order["student_id"],)).fetchone()
-    conn.commit()
-    conn.close()
-
-    if student:
-        add_notice("Заявка принята", f"Заявка #{oid} принята: {order['item']} x{order['count']}", u["name"], student["login"])
+    set_orders_status(get_db(), current_user(), [oid], "approve")
     return redirect("/orders")
 
 
 @app.route("/orders/<int:oid>/reject")
 @role_required("cook", "admin")
 def orders_reject(oid: int):
+    set_orders_status(get_db(), current_user(), [oid], "reject")
+    return redirect("/orders")
+
+
+@app.route("/orders/bulk", methods=["POST"])
+@role_required("cook", "admin")
+def orders_bulk():
     u = current_user()
-    conn = get_db_connection()
-    order = conn.execute("SELECT * FROM orders WHERE id = ?", (oid,)).fetchone()
-    if not order:
-        conn.close()
-        return redirect("/orders")
+    conn = get_db()
+    action = request.form.get("action", "")
+    order_ids = [int(x) for x in request.form.getlist("order_ids") if x.isdigit()]
+    if action not in ORDER_ACTIONS or not order_ids:
+        return render_orders_page(conn, u, error="Выберите заявки и действие.")
+    changed = set_orders_status(conn, u, order_ids, action)
+    skipped = len(set(order_ids)) - len(changed)
+    message = f"{ORDER_ACTIONS[action][4]}: {len(changed)}."
+    if skipped:
+        message += f" Пропущено (уже обработаны): {skipped}."
+    return render_orders_page(conn, u, message=message)
+
+
+def fulfil_orders(conn, u, order_ids, pay_type: str, override: bool):
+    """Serve approved orders from today's menu in one transaction; returns per-order results."""
+    conflicts = get_conflict_map(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conditions, params = ["o.status = 'approved'"], []
+        if order_ids:
+            conditions.append("o.id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(order_ids)))
+        orders_ = conn.execute(f"""
+            SELECT o.id, o.student_id, o.meal_type, o.item, o.count, o.comment,
+                   us.name, us.login, us.balance, us.allergy
+            FROM orders o JOIN users us ON us.id = o.student_id
+            WHERE {' AND '.join(conditions)} ORDER BY o.id
+        """, params).fetchall()
+        menu = {}
+        for m in conn.execute("SELECT * FROM menu_items WHERE menu_date = ?", (today_str(),)):
+            menu.setdefault((m["name"].lower(), meal_key(m["meal_type"])), m)
+            menu.setdefault((m["name"].lower(), None), m)
+        subscribed = set()
+        if pay_type == "subscription":
+            subscribed = {sid for sid, until in active_until_map(conn, {o["student_id"] for o in orders_}).items()
+                          if until}
+
+        left = {}
+        balance = {}
+        results, served = [], []
+        for o in orders_:
+            item = menu.get((o["item"].lower(), meal_key(o["meal_type"]))) or menu.get((o["item"].lower(), None))
+            price = int(item["price"] or 0) * o["count"] if item and pay_type == "balance" else 0
+            student = {"id": o["student_id"], "allergy": o["allergy"]}
+            conflict = allergy_conflict(conn, student, item, conflicts) if item else frozenset()
+            if item:
+                left.setdefault(item["id"], item["portions_available"])
+            balance.setdefault(o["student_id"], o["balance"])
+            if not item:
+                status = "Блюда нет в меню на сегодня"
+            elif conflict and not override:
+                status = f"Аллергия: {allergen_labels(conflict)}"
+            elif pay_type == "subscription" and o["student_id"] not in subscribed:
+                status = "Нет активного абонемента"
+            elif pay_type == "balance" and balance[o["student_id"]] < price:
+                status = f"Недостаточно средств (нужно {price}₽)"
+            elif left[item["id"]] < o["count"]:
+                status = "Недостаточно порций"
+            else:
+                left[item["id"]] -= o["count"]
+                balance[o["student_id"]] -= price
+                served.append((o, item, price))
+                status = "Выдано"
+            results.append({"id": o["id"], "name": o["name"], "item": o["item"], "status": status,
+                            "ok": status == "Выдано"})
+
+        if served:
+            ts = now_ts()
+            per_item = Counter()
+            for o, item, _ in served:
+                per_item[item["id"]] += o["count"]
+            conn.executemany("UPDATE menu_items SET portions_available = portions_available - ? WHERE id = ?",
+                             [(n, item_id) for item_id, n in per_item.items()])
+            charged = [(o, item, price) for o, item, price in served if price]
+            conn.executemany("UPDATE users SET balance = balance - ? WHERE id = ?",
+                             [(price, o["student_id"]) for o, _, price in charged])
+            conn.executemany(
+                "INSERT INTO transactions(ts, student_id, type, amount, note) VALUES(?,?,?,?,?)",
+                [(ts, o["student_id"], "charge", -price, f"Оплата питания: {item['name']} x{o['count']} (заявка #{o['id']})")
+                 for o, item, price in charged])
+            conn.executemany("""
+                INSERT INTO serves(ts, student_id, meal_type, item, count, pay_type, amount, comment, order_id, staff_id)
+                VALUES(?,?,?,?,?,?,?,?,?,?)
+            """, [(ts, o["student_id"], item["meal_type"], item["name"], o["count"], pay_type, price, o["comment"],
+                   o["id"], u["id"]) for o, item, price in served])
+            conn.execute("UPDATE orders SET status = 'served' WHERE id IN (SELECT value FROM json_each(?))",
+                         (json.dumps([o["id"] for o, _, _ in served]),))
+            by_item = {item["id"]: item for _, item, _ in served}
+            for item_id, n in per_item.items():
+                ledger_add(conn, by_item[item_id]["menu_date"], by_item[item_id]["name"], served=n)
+            by_meal = defaultdict(list)
+            for o, item, _ in served:
+                by_meal[item["meal_type"]].append(o["student_id"])
+            for meal_type, student_ids in by_meal.items():
+                rollup_serves(conn, ts[:10], meal_type, student_ids)
+            add_notices([("Заявка выполнена", f"Заявка #{o['id']} выдана: {item['name']} x{o['count']}",
+                          u["name"], o["login"]) for o, item, _ in served]
+                        + [("Выдача", f"Выдано по заявкам: {len(served)}.", u["name"], "admin")], commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-    conn.execute("UPDATE orders SET status='rejected' WHERE id = ?", (oid,))
-    student = conn.execute("SELECT * FROM users WHERE id = ?", (order["student_id"],)).fetchone()
-    conn.commit()
-    conn.close()
+    if served:
+        invalidate_dashboard()
+        invalidate_menu()
+        for sid in {o["student_id"] for o, _, _ in served}:
+            forget_user(sid)
+        publish_orders([o for o, _, _ in served], "served")
+    return results
 
-    if student:
-        add_notice("Заявка отклонена", f"Заявка #{oid} отклонена: {order['item']} x{order['count']}", u["name"], student["login"])
-    return redirect("/orders")
+
+@app.route("/orders/fulfil", methods=["POST"])
+@role_required("cook", "admin")
+def orders_fulfil():
+    u = current_user()
+    conn = get_db()
+    pay_type = request.form.get("pay_type", "balance").strip()
+    if pay_type not in ("balance", "subscription", "free"):
+        return render_orders_page(conn, u, error="Неверный способ оплаты.")
+    one = request.form.get("order_id", "")
+    order_ids = [int(one)] if one.isdigit() else [int(x) for x in request.form.getlist("order_ids") if x.isdigit()]
+    results = fulfil_orders(conn, u, order_ids, pay_type, request.form.get("allergy_override") == "1")
+    if not results:
+        return render_orders_page(conn, u, error="Нет принятых заявок для выдачи.")
+    done = sum(r["ok"] for r in results)
+    return render_orders_page(conn, u, message=f"Выдано по заявкам: {done} из {len(results)}.", results=results)
 
 
 @app.route("/payments")
@@ -682,21 +2164,27 @@ def payments():
         if sid and sid.isdigit():
             student_id = int(sid)
 
-    conn = get_db_connection()
+    conn = get_db()
     student = conn.execute("SELECT * FROM users WHERE id = ?", (student_id,)).fetchone()
     if not student:
-        conn.close()
         session.clear()
         return redirect("/login")
+    return render_payments_page(conn, u, student)
 
-    tx = conn.execute(
-        "SELECT * FROM transactions WHERE student_id=? ORDER BY id DESC LIMIT 200",
-        (student_id,)
-    ).fetchall()
-    conn.close()
 
-    transactions = [{"ts": r["ts"], "type": r["type"], "amount": r["amount"], "note": r["note"]} for r in tx]
-    return render_template("payments.html", user=u, balance=student["balance"], transactions=transactions)
+def render_payments_page(conn, u, student, error=None, message=None):
+    tx, pager = fetch_page(conn, "SELECT * FROM transactions", ["student_id = ?"], [student["id"]])
+    after = running_balances(conn, student["id"], [r["id"] for r in tx])
+    transactions = [{"ts": r["ts"], "type": r["type"], "amount": r["amount"], "note": r["note"],
+                     "balance_after": after[r["id"]]} for r in tx]
+
+    ledger_balance = None
+    if u["role"] == "admin":
+        ledger = ledger_balances(conn, [student["id"]])[0]
+        if ledger["balance"] != student["balance"]:
+            ledger_balance = ledger["balance"]
+    return render_template("payments.html", user=u, balance=student["balance"], transactions=transactions,
+                           pager=pager, ledger_balance=ledger_balance, error=error, message=message)
 
 
 @app.route("/payments/topup", methods=["POST"])
@@ -715,10 +2203,9 @@ def payments_topup():
         if sid and sid.isdigit():
             student_id = int(sid)
 
-    conn = get_db_connection()
+    conn = get_db()
     student = conn.execute("SELECT id FROM users WHERE id=?", (student_id,)).fetchone()
     if not student:
-        conn.close()
         return redirect("/payments")
 
     conn.execute("UPDATE users SET balance = balance + ? WHERE id=?", (amount, student_id))
@@ -726,17 +2213,199 @@ def payments_topup():
         "INSERT INTO transactions(ts, student_id, type, amount, note) VALUES(?,?,?,?,?)",
         (now_ts(), student_id, "topup", amount, f"Пополнение ({method})")
     )
+    checkpoint_balances(conn, [student_id])
     conn.commit()
-    conn.close()
+    forget_user(student_id)
 
     add_notice("Баланс пополнен", f"+{amount}₽ ({method})", "Система", "admin")
     return redirect("/payments")
 
 
+TOPUP_COLUMNS = {
+    "id": "student_id", "student_id": "student_id", "id ученика": "student_id",
+    "login": "login", "логин": "login",
+    "amount": "amount", "сумма": "amount",
+    "method": "method", "способ": "method",
+    "note": "note", "комментарий": "note",
+}
+
+
+def parse_topups(records):
+    """Validate (label, record) pairs into (student_id, login, amount, method, note) rows."""
+    rows, errors = [], []
+    for label, rec in records:
+        sid = str(rec.get("student_id") or "").strip()
+        login_ = str(rec.get("login") or "").strip()
+        try:
+            amount = int(str(rec.get("amount") or "").strip())
+        except ValueError:
+            amount = 0
+        if not (sid.isdigit() or login_):
+            errors.append(f"{label}: не указан ID или логин ученика.")
+        elif amount <= 0:
+            errors.append(f"{label}: сумма должна быть положительным целым числом.")
+        else:
+            rows.append((int(sid) if sid.isdigit() else None, login_, amount,
+                         str(rec.get("method") or "transfer").strip(), str(rec.get("note") or "").strip()))
+    return rows, errors
+
+
+def apply_bulk_topup(conn, u, rows):
+    """Apply all top-ups in one transaction; returns (applied rows, errors) and applies nothing on error."""
+    ids = [r[0] for r in rows if r[0] is not None]
+    logins = [r[1] for r in rows if r[0] is None]
+    found = conn.execute("""
+        SELECT id, login FROM users WHERE role = 'student'
+        AND (id IN (SELECT value FROM json_each(?)) OR login IN (SELECT value FROM json_each(?)))
+    """, (json.dumps(ids), json.dumps(logins))).fetchall()
+    known_ids = {r["id"] for r in found}
+    id_of_login = {r["login"]: r["id"] for r in found}
+    missing = sorted({str(r[0]) for r in rows if r[0] is not None and r[0] not in known_ids}
+                     | {r[1] for r in rows if r[0] is None and r[1] not in id_of_login})
+    if missing:
+        return [], ["Ученики не найдены: " + ", ".join(missing[:20])]
+
+    ts = now_ts()
+    applied = [(r[0] if r[0] is not None else id_of_login[r[1]], r[2],
+                f"Пополнение ({r[3]})" + (f": {r[4]}" if r[4] else "")) for r in rows]
+    try:
+        conn.executemany("UPDATE users SET balance = balance + ? WHERE id = ?", [(a, sid) for sid, a, _ in applied])
+        conn.executemany(
+            "INSERT INTO transactions(ts, student_id, type, amount, note) VALUES(?,?,?,?,?)",
+            [(ts, sid, "topup", a, note) for sid, a, note in applied])
+        students = {sid for sid, _, _ in applied}
+        checkpoint_balances(conn, students)
+        add_notice("Пакетное пополнение", f"Пополнено счетов: {len(students)}, "
+                   f"сумма {sum(a for _, a, _ in applied)}₽", u["name"], "admin", commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for sid in students:
+        forget_user(sid)
+    return applied, []
+
+
+@app.route("/payments/topup/bulk", methods=["POST"])
+@role_required("admin")
+def payments_topup_bulk():
+    # JSON: [{"student_id" or "login", "amount", "method"?, "note"?}, ...]; form: CSV file with the same columns.
+    u = current_user()
+    conn = get_db()
+    if request.is_json:
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get("items")
+        if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+            return jsonify({"errors": ["Ожидается список пополнений."]}), 400
+        records = [(f"Запись {n}", {TOPUP_COLUMNS.get(k.lower(), k): v for k, v in item.items()})
+                   for n, item in enumerate(items, start=1)]
+    else:
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            return render_payments_page(conn, u, u, error="Выберите CSV-файл.")
+        try:
+            _, records = read_csv_upload(upload.read(), TOPUP_COLUMNS)
+        except UnicodeDecodeError:
+            return render_payments_page(conn, u, u, error="Файл должен быть в кодировке UTF-8.")
+        records = [(f"Строка {n}", rec) for n, rec in records]
+
+    rows, errors = parse_topups(records)
+    if not errors and not rows:
+        errors.append("Нет пополнений.")
+    if len(rows) > BULK_TOPUP_MAX_ROWS:
+        errors.append(f"Не больше {BULK_TOPUP_MAX_ROWS} пополнений за раз.")
+    applied = []
+    if not errors:
+        applied, errors = apply_bulk_topup(conn, u, rows)
+
+    total = sum(a for _, a, _ in applied)
+    if request.is_json:
+        if errors:
+            return jsonify({"errors": errors}), 400
+        return jsonify({"applied": len(applied), "students": len({sid for sid, _, _ in applied}), "total": total})
+    if errors:
+        return render_payments_page(conn, u, u, error=" ".join(errors[:10]))
+    return render_payments_page(conn, u, u, message=f"Проведено пополнений: {len(applied)} на {total}₽.")
+
+
+# kind -> (title, roles, query with the exported table aliased as x, header row)
+EXPORTS = {
+    "transactions": ("Платежи", ("admin",), """
+        SELECT x.ts, x.student_id, u.name, u.work, x.type, x.amount, x.note
+        FROM transactions x LEFT JOIN users u ON u.id = x.student_id
+    """, ("Дата", "ID ученика", "ФИО", "Класс", "Тип", "Сумма", "Комментарий")),
+    "serves": ("Выдачи", ("cook", "admin"), """
+        SELECT x.ts, x.student_id, u.name, u.work, x.meal_type, x.item, x.count, x.pay_type, x.amount, x.comment
+        FROM serves x LEFT JOIN users u ON u.id = x.student_id
+    """, ("Дата", "ID ученика", "ФИО", "Класс", "Приём пищи", "Блюдо", "Кол-во", "Оплата", "Сумма", "Комментарий")),
+    "procurement": ("Закупки", ("cook", "admin"), """
+        SELECT x.ts, x.name, x.category, x.count, x.price, x.count * x.price, x.supplier, u.name
+        FROM procurement x LEFT JOIN users u ON u.id = x.staff_id
+    """, ("Дата", "Наименование", "Категория", "Кол-во", "Цена", "Сумма", "Поставщик", "Сотрудник")),
+    "writeoffs": ("Списания", ("cook", "admin"), """
+        SELECT x.ts, x.item, x.count, x.reason, x.comment, u.name
+        FROM writeoffs x LEFT JOIN users u ON u.id = x.staff_id
+    """, ("Дата", "Блюдо", "Кол-во", "Причина", "Комментарий", "Сотрудник")),
+}
+
+
+def export_batches(sql: str, params):
+    # Own connection: the generator outlives the request and its pooled connection.
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def export_response(kind: str, student_id=None):
+    title, _, sql, headers = EXPORTS[kind]
+    date_from, date_to = parse_period()
+    conditions, params = ["x.ts >= ?", "x.ts < ?"], [date_from, day_range(date_to)[1]]
+    if student_id is not None:
+        conditions.append("x.student_id = ?")
+        params.append(student_id)
+    sql = f"{sql} WHERE {' AND '.join(conditions)} ORDER BY x.ts, x.id"
+
+    fmt = "xlsx" if request.args.get("format") == "xlsx" else "csv"
+    batches = export_batches(sql, params)
+    if fmt == "xlsx":
+        body, mimetype = exports.xlsx_stream(headers, batches, sheet_name=title), exports.XLSX_MIMETYPE
+    else:
+        body, mimetype = exports.csv_stream(headers, batches), exports.CSV_MIMETYPE
+    filename = f"{kind}_{date_from}_{date_to}.{fmt}"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 @app.route("/payments/export")
 @login_required
 def payments_export():
-    return redirect("/payments")
+    u = current_user()
+    student_id = u["id"]
+    if u["role"] == "admin":
+        sid = request.args.get("student_id", "")
+        student_id = int(sid) if sid.isdigit() else None
+    return export_response("transactions", student_id)
+
+
+@app.route("/export/<kind>")
+@role_required("cook", "admin")
+def export(kind: str):
+    u = current_user()
+    if kind not in EXPORTS:
+        return redirect("/reports")
+    if u["role"] not in EXPORTS[kind][1]:
+        return render_template("dashboard.html", user=u, error="Недостаточно прав.")
+    return export_response(kind)
 
 @app.route("/payment", endpoint="payment_alias")
 @login_required
@@ -758,15 +2427,7 @@ def subscriptions():
         if sid and sid.isdigit():
             student_id = int(sid)
 
-    conn = get_db_connection()
-    sub = get_active_subscription(conn, student_id)
-    conn.close()
-
-    active_subscription = None
-    if sub:
-        until = date.fromisoformat(sub["until_date"])
-        active_subscription = {"until": sub["until_date"], "days_left": (until - date.today()).days}
-
+    active_subscription = get_active_subscription(get_db(), student_id)
     return render_template("subscriptions.html", user=u, active_subscription=active_subscription)
 
 
@@ -788,15 +2449,13 @@ def subscriptions_buy():
         if sid and sid.isdigit():
             student_id = int(sid)
 
-    conn = get_db_connection()
+    conn = get_db()
     student = conn.execute("SELECT * FROM users WHERE id=?", (student_id,)).fetchone()
     if not student:
-        conn.close()
         return redirect("/subscriptions")
 
     if pay_from == "balance":
         if student["balance"] < cost:
-            conn.close()
             return render_template("subscriptions.html", user=u, error="Недостаточно средств на балансе.")
         conn.execute("UPDATE users SET balance = balance - ? WHERE id=?", (cost, student_id))
         conn.execute(
@@ -805,25 +2464,18 @@ def subscriptions_buy():
         )
 
     start = date.today()
-    last = conn.execute(
-        "SELECT * FROM subscriptions WHERE student_id=? ORDER BY until_date DESC LIMIT 1",
-        (student_id,)
-    ).fetchone()
-    if last:
-        try:
-            last_until = date.fromisoformat(last["until_date"])
-            if last_until >= start:
-                start = last_until + timedelta(days=1)
-        except Exception:
-            pass
+    if student["active_until"] and student["active_until"] >= start.isoformat():
+        start = date.fromisoformat(student["active_until"]) + timedelta(days=1)
 
     until = start + timedelta(days=dur)
     conn.execute(
         "INSERT INTO subscriptions(student_id, start_date, until_date, plan) VALUES(?,?,?,?)",
         (student_id, start.isoformat(), until.isoformat(), plan)
     )
+    conn.execute("UPDATE users SET active_until = ? WHERE id = ?", (until.isoformat(), student_id))
     conn.commit()
-    conn.close()
+    remember_subscription(student_id, until)
+    forget_user(student_id)
 
     add_notice("Абонемент оформлен", f"Тариф {plan} до {until.isoformat()}", "Система", "admin")
     return redirect("/subscriptions")
@@ -832,18 +2484,22 @@ def subscriptions_buy():
 @login_required
 def notifications():
     u = current_user()
-    conn = get_db_connection()
+    conn = get_db()
 
     if u["role"] == "admin":
-        rows = conn.execute("SELECT * FROM notices ORDER BY id DESC LIMIT 200").fetchall()
+        rows, pager = fetch_page(conn, "SELECT * FROM notices", [], [])
     else:
-        rows = conn.execute("""
-            SELECT * FROM notices
-            WHERE recipient IN (?, 'all', 'students', 'cook', 'admin')
-            ORDER BY id DESC LIMIT 200
-        """, (u["login"],)).fetchall()
-
-    conn.close()
+        # One index seek on (recipient, id) per recipient, merged newest first; an IN (...) filter
+        # would sort every matching notice before applying the LIMIT.
+        before, size = page_args()
+        before = int(before) if before.isdigit() else 2 ** 63 - 1
+        streams = [conn.execute(
+            "SELECT * FROM notices WHERE recipient = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (recipient, before, size + 1)
+        ) for recipient in dict.fromkeys([u["login"], *NOTICE_PUBLIC_RECIPIENTS])]
+        rows = list(islice(heapq.merge(*streams, key=lambda r: r["id"], reverse=True), size + 1))
+        pager = make_pager(rows[size - 1]["id"] if len(rows) > size else None)
+        rows = rows[:size]
 
     notices = [{
         "title": r["title"],
@@ -853,7 +2509,34 @@ def notifications():
         "text": r["text"],
     } for r in rows]
 
-    return render_template("notifications.html", user=u, notices=notices)
+    return render_template("notifications.html", user=u, notices=notices, pager=pager)
+
+
+@app.route("/notifications/stream")
+@login_required
+def notifications_stream():
+    u = current_user()
+    viewer = {"id": u["id"], "role": u["role"], "login": u["login"]}
+    q = live_subscribe()
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event, data = q.get(timeout=LIVE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                if live_visible(event, data, viewer):
+                    yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            live_unsubscribe(q)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/complaint", methods=["GET", "POST"])
@@ -880,13 +2563,12 @@ def complaint():
         if not text:
             return render_template("complaint.html", user=u, error="Опишите проблему (текст обязателен).")
 
-        conn = get_db_connection()
+        conn = get_db()
         conn.execute("""
             INSERT INTO complaints(ts, student_id, meal_date, meal_type, item, rating, text, status)
             VALUES(?,?,?,?,?,?,?, 'new')
         """, (now_ts(), u["id"], meal_date, meal_type, item, rating_val, text))
         conn.commit()
-        conn.close()
 
         add_notice("Жалоба", f"{u['name']} отправил жалобу по питанию", u["name"], "admin")
         return redirect("/complaints?mine=1")
@@ -901,31 +2583,19 @@ def complaints():
     show_all = request.args.get("all") == "1"
     mine = request.args.get("mine") == "1"
 
-    conn = get_db_connection()
+    conn = get_db()
 
+    sql = """
+        SELECT c.*, us.name AS student_name
+        FROM complaints c JOIN users us ON us.id=c.student_id
+    """
     if u["role"] in ("cook", "admin"):
         if show_all:
-            rows = conn.execute("""
-                SELECT c.*, us.name AS student_name
-                FROM complaints c JOIN users us ON us.id=c.student_id
-                ORDER BY c.id DESC LIMIT 300
-            """).fetchall()
+            rows, pager = fetch_page(conn, sql, [], [], "c.id")
         else:
-            rows = conn.execute("""
-                SELECT c.*, us.name AS student_name
-                FROM complaints c JOIN users us ON us.id=c.student_id
-                WHERE c.status NOT IN ('resolved','rejected')
-                ORDER BY c.id DESC LIMIT 300
-            """).fetchall()
+            rows, pager = fetch_page(conn, sql, ["c.status NOT IN ('resolved','rejected')"], [], "c.id")
     else:
-        rows = conn.execute("""
-            SELECT c.*, us.name AS student_name
-            FROM complaints c JOIN users us ON us.id=c.student_id
-            WHERE c.student_id=?
-            ORDER BY c.id DESC LIMIT 300
-        """, (u["id"],)).fetchall()
-
-    conn.close()
+        rows, pager = fetch_page(conn, sql, ["c.student_id = ?"], [u["id"]], "c.id")
 
     items = []
     for r in rows:
@@ -945,7 +2615,7 @@ def complaints():
             "answered_ts": r["answered_ts"],
         })
 
-    return render_template("complaints.html", user=u, complaints=items, show_all=show_all, mine=mine)
+    return render_template("complaints.html", user=u, complaints=items, show_all=show_all, mine=mine, pager=pager)
 
 
 @app.route("/complaints/<int:cid>/answer", methods=["POST"])
@@ -958,10 +2628,9 @@ def complaints_answer(cid: int):
     if action not in ("resolved", "rejected", "in_review"):
         action = "resolved"
 
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute("SELECT * FROM complaints WHERE id=?", (cid,)).fetchone()
     if not row:
-        conn.close()
         return redirect("/complaints")
 
     conn.execute("""
@@ -971,7 +2640,6 @@ def complaints_answer(cid: int):
     """, (action, answer or None, now_ts(), u["id"], cid))
     student = conn.execute("SELECT * FROM users WHERE id=?", (row["student_id"],)).fetchone()
     conn.commit()
-    conn.close()
 
     if student:
         add_notice("Ответ по жалобе", "По вашей жалобе был дан ответ (см. раздел 'Жалобы').", u["name"], student["login"])
@@ -983,7 +2651,7 @@ def complaints_answer(cid: int):
 @role_required("cook", "admin")
 def procurement():
     u = current_user()
-    conn = get_db_connection()
+    conn = get_db()
 
     if request.method == "POST":
         name = request.form.get("itemName", "").strip()
@@ -993,7 +2661,6 @@ def procurement():
         supplier = request.form.get("supplier", "").strip()
 
         if not all([name, category, supplier]) or price <= 0 or count <= 0:
-            conn.close()
             return render_template("procurement.html", user=u, error="Некорректные данные закупки.")
 
         conn.execute("""
@@ -1003,202 +2670,407 @@ def procurement():
         conn.commit()
         add_notice("Закупки", f"Добавлено: {name} ({category}) x{count} по {price}₽ — {supplier}", u["name"], "admin")
 
-    rows = conn.execute("SELECT * FROM procurement ORDER BY id DESC LIMIT 200").fetchall()
-    conn.close()
+    rows, pager = fetch_page(conn, "SELECT * FROM procurement", [], [])
 
     plans = [{"id": r["id"], "name": r["name"], "category": r["category"], "count": r["count"],
               "price": r["price"], "supplier": r["supplier"]} for r in rows]
 
-    return render_template("procurement.html", user=u, plans=plans)
+    return render_template("procurement.html", user=u, plans=plans, pager=pager)
+
+REPORT_FORMATS = ("html", "csv")
+REPORT_GRANULARITY = {
+    "day": ("substr(ts,1,10)", "по дням"),
+    "week": ("date(ts, 'weekday 0', '-6 days')", "по неделям"),
+    "month": ("substr(ts,1,7)", "по месяцам"),
+}
+REPORT_STATUS_RU = {
+    "queued": "В очереди",
+    "running": "Формируется",
+    "done": "Готов",
+    "failed": "Ошибка",
+}
+
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+
+def build_report_sections(conn, date_from: str, date_to: str, granularity: str):
+    """Returns [(caption, headers, rows)] for the period report."""
+    period = (date_from, day_range(date_to)[1])
+    bucket, bucket_ru = REPORT_GRANULARITY[granularity]
+    sections = []
+
+    def add(caption, headers, rows):
+        sections.append((caption, headers, [tuple(r) for r in rows]))
+
+    add(f"Выдачи {bucket_ru}", ("Период", "Выдач", "Порций", "Учеников", "Выручка, ₽"), conn.execute(f"""
+        SELECT {bucket} AS period, COUNT(*), SUM(count), COUNT(DISTINCT student_id), SUM(amount)
+        FROM serves WHERE ts >= ? AND ts < ?
+        GROUP BY period ORDER BY period
+    """, period))
+
+    summary = term_summary(conn, date_from, date_to)
+    add("Выручка по приёмам пищи", ("Приём пищи", "Порций", "Выручка, ₽"),
+        [(meal, summary["portions_by_meal"].get(meal, 0), total) for meal, total in summary["revenue_by_meal"].items()])
+    add("Выручка по способу оплаты", ("Оплата", "Выручка, ₽"), summary["revenue_by_pay_type"].items())
+    add("Выручка по классам", ("Класс", "Выручка, ₽"), sorted(summary["revenue_by_class"].items()))
+    p = summary["spend_percentiles"]
+    add("Траты на ученика, ₽", ("Медиана", "p90", "p99"), [(round(p[50]), round(p[90]), round(p[99]))])
+
+    add("Списания по причинам", ("Причина", "Записей", "Порций"), conn.execute("""
+        SELECT reason, COUNT(*), SUM(count) FROM writeoffs WHERE ts >= ? AND ts < ?
+        GROUP BY reason ORDER BY 3 DESC
+    """, period))
+    add("Закупки по категориям", ("Категория", "Позиций", "Кол-во", "Сумма, ₽"), conn.execute("""
+        SELECT category, COUNT(*), SUM(count), SUM(count * price) FROM procurement WHERE ts >= ? AND ts < ?
+        GROUP BY category ORDER BY 4 DESC
+    """, period))
+    add("Закупки по поставщикам", ("Поставщик", "Позиций", "Сумма, ₽"), conn.execute("""
+        SELECT supplier, COUNT(*), SUM(count * price) FROM procurement WHERE ts >= ? AND ts < ?
+        GROUP BY supplier ORDER BY 3 DESC
+    """, period))
+    add("Жалобы", ("Статус", "Жалоб", "Средняя оценка"), [
+        (COMPLAINT_STATUS_RU.get(r[0], r[0]), r[1], "—" if r[2] is None else round(r[2], 1))
+        for r in conn.execute("SELECT status, COUNT(*), AVG(rating) FROM complaints WHERE ts >= ? AND ts < ? GROUP BY status", period)
+    ])
+    add("Заявки", ("Статус", "Заявок", "Порций"), [
+        (ORDER_STATUS_RU.get(r[0], r[0]), r[1], r[2])
+        for r in conn.execute("SELECT status, COUNT(*), SUM(count) FROM orders WHERE ts >= ? AND ts < ? GROUP BY status", period)
+    ])
+    return sections
+
+
+def write_report_file(path: str, job, sections):
+    tmp = path + ".part"
+    if job["fmt"] == "csv":
+        with open(tmp, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow([job["title"]])
+            for caption, headers, rows in sections:
+                writer.writerows([[], [caption], headers])
+                writer.writerows(rows)
+    else:
+        with app.app_context():
+            html = render_template("report_file.html", title=job["title"], generated=now_ts(), sections=sections)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(html)
+    os.replace(tmp, path)
+
+
+def run_report_job(rid: int):
+    conn = get_db_connection()
+    try:
+        conn.execute("UPDATE reports SET status='running' WHERE id=?", (rid,))
+        conn.commit()
+        job = conn.execute("SELECT * FROM reports WHERE id=?", (rid,)).fetchone()
+        # One read snapshot, so the stamped data_version matches exactly what went into the file.
+        conn.execute("BEGIN")
+        version = data_version(conn)
+        sections = build_report_sections(conn, job["period_from"], job["period_to"], job["granularity"])
+        conn.commit()
+        write_report_file(os.path.join(REPORTS_DIR, job["filename"]), job, sections)
+        conn.execute("UPDATE reports SET status='done', finished_ts=?, data_version=? WHERE id=?", (now_ts(), version, rid))
+        conn.execute(INSERT_NOTICE_SQL, (now_ts(), "Отчёт сформирован", job["title"], "Система", "admin"))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        app.logger.exception("Report job %s failed", rid)
+        conn.execute("UPDATE reports SET status='failed', error=?, finished_ts=? WHERE id=?", (str(e)[:500], now_ts(), rid))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def submit_report_job(rid: int):
+    global _report_pool
+    if not REPORTS_ASYNC or app.testing:
+        run_report_job(rid)
+        return
+    with _report_pool_lock:
+        if _report_pool is None:
+            _report_pool = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+    _report_pool.submit(run_report_job, rid)
+
 
 @app.route("/reports")
 @role_required("admin")
 def reports():
     u = current_user()
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM reports ORDER BY id DESC LIMIT 200").fetchall()
-    conn.close()
+    conn = get_db()
+    date_from, date_to = parse_period()
+    rows, pager = fetch_page(conn, "SELECT * FROM reports", [], [])
 
-    reports_list = [{"id": r["id"], "title": r["title"]} for r in rows]
-    return render_template("reports.html", user=u, reports=reports_list)
+    reports_list = [{"id": r["id"], "title": r["title"], "ts": r["ts"], "fmt": r["fmt"], "status": r["status"],
+                     "status_ru": REPORT_STATUS_RU.get(r["status"], r["status"]), "error": r["error"]} for r in rows]
+    pending = any(r["status"] in ("queued", "running") for r in reports_list)
+    return render_template("reports.html", user=u, reports=reports_list, pager=pager, pending=pending,
+                           date_from=date_from, date_to=date_to)
 
 
-@app.route("/reports/create")
+@app.route("/reports/create", methods=["GET", "POST"])
 @role_required("admin")
 def reports_create():
     u = current_user()
-    conn = get_db_connection()
-
-    menu_count = conn.execute("SELECT COUNT(*) AS c FROM menu_items WHERE menu_date=?", (today_str(),)).fetchone()["c"]
-    orders_new = conn.execute("SELECT COUNT(*) AS c FROM orders WHERE status='new'").fetchone()["c"]
-    serves_today = conn.execute("SELECT IFNULL(SUM(count),0) AS c FROM serves WHERE substr(ts,1,10)=?", (today_str(),)).fetchone()["c"]
-    writeoff_today = conn.execute("SELECT IFNULL(SUM(count),0) AS c FROM writeoffs WHERE substr(ts,1,10)=?", (today_str(),)).fetchone()["c"]
-    proc_count = conn.execute("SELECT COUNT(*) AS c FROM procurement").fetchone()["c"]
-
-    next_id = conn.execute("SELECT IFNULL(MAX(id),0)+1 AS nxt FROM reports").fetchone()["nxt"]
-    title = f"Отчёт #{next_id} — {today_str()}"
-    filename = f"report_{next_id}.txt"
-    path = os.path.join(REPORTS_DIR, filename)
-
-    with open(path, "w", encoding="utf-8") as f:
-        f.write("=== Система управления столовой ===\n")
-        f.write(f"Дата формирования: {now_ts()}\n")
-        f.write(f"Создатель: {u['name']} (admin)\n\n")
-        f.write("Сводка:\n")
-        f.write(f"- Позиции меню на сегодня: {menu_count}\n")
-        f.write(f"- Новые заявки: {orders_new}\n")
-        f.write(f"- Выдано сегодня (порций): {serves_today}\n")
-        f.write(f"- Списано сегодня (порций): {writeoff_today}\n")
-        f.write(f"- Позиции в закупках: {proc_count}\n")
-        f.write("\nКонец отчёта.\n")
-
-    conn.execute("INSERT INTO reports(ts, title, filename) VALUES(?,?,?)", (now_ts(), title, filename))
+    conn = get_db()
+    date_from, date_to = parse_period()
+    granularity = request.values.get("granularity", "day")
+    if granularity not in REPORT_GRANULARITY:
+        granularity = "day"
+    fmt = request.values.get("format", "html")
+    if fmt not in REPORT_FORMATS:
+        fmt = "html"
+
+    version = data_version(conn)
+    cached = find_cached_report(conn, date_from, date_to, granularity, fmt, version)
+    if cached:
+        return redirect(f"/reports/{cached['id']}/download" if cached["status"] == "done" else "/reports")
+
+    title = f"Отчёт за {date_from} — {date_to} ({REPORT_GRANULARITY[granularity][1]}, {fmt.upper()})"
+    cur = conn.execute("""
+        INSERT INTO reports(ts, title, filename, status, fmt, period_from, period_to, granularity, created_by,
+                            data_version, owner)
+        VALUES(?,?,'','queued',?,?,?,?,?,?,?)
+    """, (now_ts(), title, fmt, date_from, date_to, granularity, u["id"], version, report_owner()))
+    rid = cur.lastrowid
+    # The row id makes the name unique however many jobs are created at once.
+    conn.execute("UPDATE reports SET filename=? WHERE id=?", (f"report_{rid}_{date_from}_{date_to}.{fmt}", rid))
     conn.commit()
-    conn.close()
 
-    add_notice("Отчёт сформирован", title, u["name"], "admin")
+    submit_report_job(rid)
     return redirect("/reports")
 
 
 @app.route("/reports/<int:rid>/download")
 @role_required("admin")
 def reports_download(rid: int):
-    conn = get_db_connection()
+    conn = get_db()
     row = conn.execute("SELECT * FROM reports WHERE id=?", (rid,)).fetchone()
-    conn.close()
-    if not row:
+    if not row or row["status"] != "done":
         return redirect("/reports")
-    return send_from_directory(REPORTS_DIR, row["filename"], as_attachment=True)
+    # Finished report files never change, so the row identity is a strong validator;
+    # Last-Modified comes from the file mtime and conditional requests get 304.
+    return send_from_directory(os.path.abspath(REPORTS_DIR), row["filename"], as_attachment=True,
+                               etag=f"report-{rid}-{row['data_version'] or 0}")
 
 
-def _stub_page(title: str, text: str):
-    u = current_user()
-    return render_template_string(
-        """
-        {% extends "base.html" %}
-        {% block title %}{{ title }}{% endblock %}
-        {% block content %}
-          <div class="card shadow-soft p-4">
-            <h3 class="mb-2">{{ title }}</h3>
-            <div class="text-muted">{{ text }}</div>
-          </div>
-        {% endblock %}
-        """,
-        user=u, title=title, text=text
+def render_serve_page(conn, u, error=None, message=None, batch_results=None):
+    classes = [r["work"] for r in conn.execute("SELECT DISTINCT work FROM users WHERE role='student' ORDER BY work")]
+    menu_today = conn.execute("""
+        SELECT id, name, meal_type, price, portions_available
+        FROM menu_items
+        WHERE menu_date=?
+        ORDER BY meal_type, name
+    """, (today_str(),)).fetchall()
+
+    history = conn.execute("""
+        SELECT s.*, u.name AS student_name
+        FROM serves s
+        JOIN users u ON u.id = s.student_id
+        ORDER BY s.id DESC
+        LIMIT 100
+    """).fetchall()
+
+    return render_template(
+        "serve.html",
+        user=u,
+        classes=classes,
+        menu_today=menu_today,
+        history=history,
+        batch_results=batch_results,
+        error=error,
+        message=message,
+        MEAL_RU=MEAL_RU
     )
 
+
 @app.route("/serve", methods=["GET", "POST"], endpoint="serve")
 @role_required("cook", "admin")
 def serve():
     u = current_user()
-    conn = get_db_connection()
+    conn = get_db()
     error = None
     message = None
 
-    students = conn.execute("SELECT id, name, work FROM users WHERE role='student' ORDER BY name").fetchall()
-    menu_today = conn.execute("""
-        SELECT id, name, meal_type, price, portions_available
-        FROM menu_items
-        WHERE menu_date=?
-        ORDER BY meal_type, name
-    """, (today_str(),)).fetchall()
-
     if request.method == "POST":
         student_id = int(request.form.get("student_id", "0") or 0)
         item_id = int(request.form.get("item_id", "0") or 0)
         count = int(request.form.get("count", "1") or 1)
         pay_type = request.form.get("pay_type", "balance").strip()
         comment = request.form.get("comment", "").strip() or None
+        override = request.form.get("allergy_override") == "1"
 
         if student_id <= 0 or item_id <= 0 or count <= 0:
             error = "Заполните все поля корректно."
+        elif pay_type not in ("balance", "subscription", "free"):
+            error = "Неверный способ оплаты."
         else:
-            student = conn.execute("SELECT * FROM users WHERE id=?", (student_id,)).fetchone()
-            item = conn.execute("SELECT * FROM menu_items WHERE id=?", (item_id,)).fetchone()
-
-            if not student or student["role"] != "student":
-                error = "Ученик не найден."
-            elif not item:
-                error = "Блюдо не найдено."
-            elif item["portions_available"] < count:
-                error = f"Недостаточно порций. Доступно: {item['portions_available']}."
-            else:
-
-                amount = int(item["price"] or 0) * count
-
-                if pay_type == "balance":
-                    if student["balance"] < amount:
-                        error = f"Недостаточно средств на балансе ученика. Нужно {amount}₽."
-                    else:
-                        conn.execute("UPDATE users SET balance = balance - ? WHERE id=?", (amount, student_id))
+            conflicts = get_conflict_map(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                student = conn.execute("SELECT * FROM users WHERE id=?", (student_id,)).fetchone()
+                item = conn.execute("SELECT * FROM menu_items WHERE id=?", (item_id,)).fetchone()
+                amount = int(item["price"] or 0) * count if item and pay_type == "balance" else 0
+                conflict = allergy_conflict(conn, student, item, conflicts) if student and item else frozenset()
+
+                if not student or student["role"] != "student":
+                    error = "Ученик не найден."
+                elif not item:
+                    error = "Блюдо не найдено."
+                elif conflict and not override:
+                    error = (f"Аллергия ученика: {allergen_labels(conflict)}. Если выдача согласована, "
+                             f"отметьте «Выдать, несмотря на аллергию».")
+                elif pay_type == "subscription" and not get_active_subscription(conn, student_id):
+                    error = "У ученика нет активного абонемента."
+                elif conn.execute(
+                    "UPDATE menu_items SET portions_available = portions_available - ? WHERE id=? AND portions_available >= ?",
+                    (count, item_id, count)
+                ).rowcount == 0:
+                    error = f"Недостаточно порций. Доступно: {item['portions_available']}."
+                elif pay_type == "balance" and conn.execute(
+                    "UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?",
+                    (amount, student_id, amount)
+                ).rowcount == 0:
+                    error = f"Недостаточно средств на балансе ученика. Нужно {amount}₽."
+                else:
+                    ts = now_ts()
+                    if pay_type == "balance":
                         conn.execute(
                             "INSERT INTO transactions(ts, student_id, type, amount, note) VALUES(?,?,?,?,?)",
-                            (now_ts(), student_id, "charge", -amount, f"Оплата питания: {item['name']} x{count}")
+                            (ts, student_id, "charge", -amount, f"Оплата питания: {item['name']} x{count}")
                         )
-
-                elif pay_type == "subscription":
-                    sub = get_active_subscription(conn, student_id)
-                    if not sub:
-                        error = "У ученика нет активного абонемента."
-                    else:
-                        amount = 0  
-
-                elif pay_type == "free":
-                    amount = 0
-                else:
-                    error = "Неверный способ оплаты."
-
-                if not error:
-                    conn.execute(
-                        "UPDATE menu_items SET portions_available = portions_available - ? WHERE id=?",
-                        (count, item_id)
-                    )
-
                     conn.execute("""
                         INSERT INTO serves(ts, student_id, meal_type, item, count, pay_type, amount, comment, staff_id)
                         VALUES(?,?,?,?,?,?,?,?,?)
-                    """, (now_ts(), student_id, item["meal_type"], item["name"], count, pay_type, amount, comment, u["id"]))
+                    """, (ts, student_id, item["meal_type"], item["name"], count, pay_type, amount, comment, u["id"]))
+                    ledger_add(conn, item["menu_date"], item["name"], served=count)
+                    rollup_serves(conn, ts[:10], item["meal_type"], [student_id])
+                    note = f" Аллергия ({allergen_labels(conflict)}), выдано по согласованию." if conflict else ""
+                    add_notice("Выдача", f"{student['name']} получил {item['name']} x{count}.{note}", u["name"], "admin", commit=False)
+            except Exception:
+                conn.rollback()
+                raise
 
+            if error:
+                conn.rollback()
+            else:
+                conn.commit()
+                invalidate_dashboard()
+                invalidate_menu()
+                forget_user(student_id)
+                message = f"Выдача выполнена: {student['name']} получил {item['name']} x{count}."
 
-                    conn.commit()
-                    message = f"Выдача выполнена: {student['name']} получил {item['name']} x{count}."
+    return render_serve_page(conn, u, error=error, message=message)
 
-                    add_notice("Выдача", f"{student['name']} получил {item['name']} x{count}.", u["name"], "admin")
 
-                    menu_today = conn.execute("""
-                        SELECT id, name, meal_type, price, portions_available
-                        FROM menu_items
-                        WHERE menu_date=?
-                        ORDER BY meal_type, name
-                    """, (today_str(),)).fetchall()
+@app.route("/serve/batch", methods=["POST"], endpoint="serve_batch")
+@role_required("cook", "admin")
+def serve_batch():
+    u = current_user()
+    conn = get_db()
 
-    history = conn.execute("""
-        SELECT s.*, u.name AS student_name
-        FROM serves s
-        JOIN users u ON u.id = s.student_id
-        ORDER BY s.id DESC
-        LIMIT 100
-    """).fetchall()
+    work = request.form.get("work", "").strip()
+    raw_ids = request.form.get("student_ids", "").replace(",", " ").split()
+    student_ids = [int(x) for x in raw_ids if x.isdigit()]
+    item_id = int(request.form.get("item_id", "0") or 0)
+    count = int(request.form.get("count", "1") or 1)
+    pay_type = request.form.get("pay_type", "balance").strip()
+    comment = request.form.get("comment", "").strip() or None
+    override = request.form.get("allergy_override") == "1"
 
-    conn.close()
+    if (not work and not student_ids) or item_id <= 0 or count <= 0:
+        return render_serve_page(conn, u, error="Укажите класс или список учеников и блюдо.")
+    if pay_type not in ("balance", "subscription", "free"):
+        return render_serve_page(conn, u, error="Неверный способ оплаты.")
 
-    return render_template(
-        "serve.html",
-        user=u,
-        students=students,
-        menu_today=menu_today,
-        history=history,
-        error=error,
-        message=message,
-        MEAL_RU=MEAL_RU
-    )
+    conflicts = get_conflict_map(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        item = conn.execute("SELECT * FROM menu_items WHERE id=?", (item_id,)).fetchone()
+        if student_ids:
+            marks = ",".join("?" * len(student_ids))
+            students = conn.execute(
+                f"SELECT id, name, balance, allergy FROM users WHERE role='student' AND id IN ({marks}) ORDER BY name",
+                student_ids
+            ).fetchall()
+        else:
+            students = conn.execute(
+                "SELECT id, name, balance, allergy FROM users WHERE role='student' AND work=? ORDER BY name",
+                (work,)
+            ).fetchall()
+
+        if not item:
+            conn.rollback()
+            return render_serve_page(conn, u, error="Блюдо не найдено.")
+        if not students:
+            conn.rollback()
+            return render_serve_page(conn, u, error="Ученики не найдены.")
+
+        subscribed = set()
+        if pay_type == "subscription":
+            subscribed = {sid for sid, until in active_until_map(conn, [s["id"] for s in students]).items() if until}
+
+        price = int(item["price"] or 0) * count if pay_type == "balance" else 0
+        left = item["portions_available"]
+        results, served = [], []
+        for s in students:
+            conflict = allergy_conflict(conn, s, item, conflicts)
+            if conflict and not override:
+                status = f"Аллергия: {allergen_labels(conflict)}"
+            elif pay_type == "subscription" and s["id"] not in subscribed:
+                status = "Нет активного абонемента"
+            elif pay_type == "balance" and s["balance"] < price:
+                status = f"Недостаточно средств (нужно {price}₽)"
+            elif left < count:
+                status = "Недостаточно порций"
+            else:
+                left -= count
+                served.append(s)
+                status = "Выдано"
+            results.append({"id": s["id"], "name": s["name"], "status": status, "ok": status == "Выдано"})
+
+        if served:
+            total = count * len(served)
+            ts = now_ts()
+            conn.execute(
+                "UPDATE menu_items SET portions_available = portions_available - ? WHERE id=? AND portions_available >= ?",
+                (total, item_id, total)
+            )
+            if pay_type == "balance":
+                conn.executemany(
+                    "UPDATE users SET balance = balance - ? WHERE id=?",
+                    [(price, s["id"]) for s in served]
+                )
+                conn.executemany(
+                    "INSERT INTO transactions(ts, student_id, type, amount, note) VALUES(?,?,?,?,?)",
+                    [(ts, s["id"], "charge", -price, f"Оплата питания: {item['name']} x{count}") for s in served]
+                )
+            conn.executemany("""
+                INSERT INTO serves(ts, student_id, meal_type, item, count, pay_type, amount, comment, staff_id)
+                VALUES(?,?,?,?,?,?,?,?,?)
+            """, [(ts, s["id"], item["meal_type"], item["name"], count, pay_type, price, comment, u["id"]) for s in served])
+            ledger_add(conn, item["menu_date"], item["name"], served=total)
+            rollup_serves(conn, ts[:10], item["meal_type"], [s["id"] for s in served])
+            add_notice("Выдача", f"Групповая выдача {work or 'по списку'}: {item['name']} x{count}, учеников: {len(served)}.",
+                       u["name"], "admin", commit=False)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if served:
+        invalidate_dashboard()
+        invalidate_menu()
+        for s in served:
+            forget_user(s["id"])
+    message = f"Групповая выдача: {len(served)} из {len(students)} учеников получили {item['name']} x{count}."
+    return render_serve_page(conn, u, message=message, batch_results=results)
 
 
 @app.route("/writeoff", methods=["GET", "POST"], endpoint="writeoff")
 @role_required("cook", "admin")
 def writeoff():
     u = current_user()
-    conn = get_db_connection()
+    conn = get_db()
     error = None
     message = None
 
@@ -1221,20 +3093,24 @@ def writeoff():
             item = conn.execute("SELECT * FROM menu_items WHERE id=?", (item_id,)).fetchone()
             if not item:
                 error = "Позиция не найдена."
-            elif item["portions_available"] < count:
+            elif conn.execute(
+                "UPDATE menu_items SET portions_available = portions_available - ? WHERE id=? AND portions_available >= ?",
+                (count, item_id, count)
+            ).rowcount == 0:
+                conn.rollback()
                 error = f"Недостаточно порций. Доступно: {item['portions_available']}."
             else:
-                conn.execute(
-                    "UPDATE menu_items SET portions_available = portions_available - ? WHERE id=?",
-                    (count, item_id)
-                )
-
+                ts = now_ts()
                 conn.execute("""
                     INSERT INTO writeoffs(ts, item, count, reason, comment, staff_id)
                     VALUES(?,?,?,?,?,?)
-                """, (now_ts(), item["name"], count, reason, comment, u["id"]))
+                """, (ts, item["name"], count, reason, comment, u["id"]))
+                ledger_add(conn, item["menu_date"], item["name"], written_off=count)
+                rollup_writeoff(conn, ts[:10], item["name"], reason, count)
 
                 conn.commit()
+                invalidate_dashboard()
+                invalidate_menu()
                 message = f"Списано: {item['name']} x{count}."
 
                 add_notice("Списание", f"Списано {item['name']} x{count}. Причина: {reason}", u["name"], "admin")
@@ -1254,8 +3130,6 @@ def writeoff():
         LIMIT 100
     """).fetchall()
 
-    conn.close()
-
     return render_template(
         "writeoff.html",
         user=u,
@@ -1267,16 +3141,394 @@ def writeoff():
     )
 
 
+ROLE_RU = {
+    "student": "Ученик",
+    "cook": "Повар",
+    "admin": "Админ",
+}
+USER_SEARCH_LIMIT = 20
+IMPORT_COLUMNS = {
+    "login": "login", "логин": "login",
+    "password": "password", "пароль": "password",
+    "name": "name", "фио": "name",
+    "work": "work", "класс": "work",
+    "benefit": "benefit", "льгота": "benefit",
+    "allergy": "allergy", "аллергии": "allergy",
+}
+_user_fts = [None]
+
+
+def user_search_condition(conn, q: str):
+    """Condition on users.id matching every word of q as a prefix of name, login or class."""
+    words = q.split()
+    if _user_fts[0] is None:
+        _user_fts[0] = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'").fetchone() is not None
+    if _user_fts[0]:
+        match = " ".join('"' + w.replace('"', '""') + '"*' for w in words)
+        return "id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)", [match]
+    conditions, params = [], []
+    for w in words:
+        conditions.append("(name LIKE ? OR login LIKE ? OR work LIKE ?)")
+        params += [f"{w}%", f"{w}%", f"{w}%"]
+    return " AND ".join(conditions), params
+
+
+def read_csv_upload(data: bytes, columns: dict):
+    """Header keys and (line number, record) pairs of an uploaded CSV; ``columns`` maps header names to keys."""
+    text = data.decode("utf-8-sig")
+    first = text.split("\n", 1)[0]
+    reader = csv.reader(io.StringIO(text), delimiter=";" if first.count(";") >= first.count(",") else ",")
+    header = [columns.get(h.strip().lower()) for h in next(reader, [])]
+    records = [(line_no, {key: v.strip() for key, v in zip(header, values) if key})
+               for line_no, values in enumerate(reader, start=2) if any(v.strip() for v in values)]
+    return set(header), records
+
+
+def parse_user_import(data: bytes, default_work: str):
+    header, records = read_csv_upload(data, IMPORT_COLUMNS)
+    required = {"login", "password", "name"} | (set() if default_work else {"work"})
+    if required - header:
+        return [], ["Нет обязательных столбцов: " + ", ".join(sorted(required - header))]
+
+    rows, errors = [], []
+    for line_no, rec in records:
+        work = rec.get("work") or default_work
+        if not all([rec.get("login"), rec.get("password"), rec.get("name"), work]):
+            errors.append(f"Строка {line_no}: не заполнены логин, пароль, ФИО или класс.")
+            continue
+        rows.append(("student", rec["login"], rec["password"], rec["name"], work,
+                     rec.get("benefit") or None, rec.get("allergy") or None))
+    return rows, errors
+
+
+def render_users_page(conn, u, error=None, message=None):
+    q = request.args.get("q", "").strip()
+    role = request.args.get("role", "")
+    conditions, params = [], []
+    if q:
+        cond, cond_params = user_search_condition(conn, q)
+        conditions.append(cond)
+        params += cond_params
+    if role in ROLE_RU:
+        conditions.append("role = ?")
+        params.append(role)
+    rows, pager = fetch_page(conn, "SELECT id, role, login, name, work FROM users", conditions, params)
+
+    users_list = [{"id": r["id"], "name": r["name"], "login": r["login"], "work": r["work"],
+                   "role": ROLE_RU.get(r["role"], r["role"])} for r in rows]
+    return render_template("users.html", user=u, users=users_list, pager=pager, q=q, role=role, ROLE_RU=ROLE_RU,
+                           error=error, message=message)
+
+
 @app.route("/users", endpoint="users")
 @role_required("admin")
 def users():
-    return _stub_page("Пользователи", "Раздел 'Пользователи' пока не реализован в app.py. Это заглушка, чтобы меню не падало.")
+    return render_users_page(get_db(), current_user())
+
+
+@app.route("/users/search")
+@role_required("cook", "admin")
+def users_search():
+    q = request.args.get("q", "").strip()
+    role = request.args.get("role", "student")
+    if not q or role not in ROLE_RU:
+        return jsonify([])
+    conn = get_db()
+    cond, params = user_search_condition(conn, q)
+    rows = conn.execute(f"""
+        SELECT id, name, work, allergy FROM users
+        WHERE role = ? AND {cond}
+        ORDER BY name LIMIT ?
+    """, [role] + params + [USER_SEARCH_LIMIT]).fetchall()
+    return jsonify([{"id": r["id"], "name": r["name"], "work": r["work"],
+                     "allergy": allergen_labels(allergen_codes(r["allergy"]))} for r in rows])
+
+
+PAY_TYPE_RU = {
+    "balance": "баланс",
+    "subscription": "абонемент",
+    "free": "бесплатно",
+}
+
+
+def _meal_ru(meal_type):
+    return MEAL_RU.get(meal_key(meal_type), meal_type)
+
+
+# Timeline sources, merged newest first. Each is read through its (student_id) index in id order,
+# which is also ts order since rows are only ever appended with the current time.
+TIMELINE_SOURCES = (
+    ("SELECT id, ts, item, count, meal_type, pay_type, amount FROM serves",
+     lambda r: ("Выдача", f"{r['item']} x{r['count']} — {_meal_ru(r['meal_type'])}, "
+                          f"{PAY_TYPE_RU.get(r['pay_type'], r['pay_type'])}, {r['amount']}₽")),
+    ("SELECT id, ts, item, count, meal_type, status FROM orders",
+     lambda r: ("Заявка", f"{r['item']} x{r['count']} — {_meal_ru(r['meal_type'])}, "
+                          f"{ORDER_STATUS_RU.get(r['status'], r['status']).lower()}")),
+    ("SELECT id, ts, type, amount, note FROM transactions",
+     lambda r: ("Пополнение" if r["type"] == "topup" else "Оплата", f"{r['note'] or r['type']}: {r['amount']}₽")),
+    ("SELECT id, ts, item, rating, text, status FROM complaints",
+     lambda r: ("Жалоба", f"{r['item'] or '—'}: {r['text'][:120]} "
+                          f"({COMPLAINT_STATUS_RU.get(r['status'], r['status']).lower()})")),
+)
+
+
+def student_timeline(conn, student_id: int, before: str, size: int):
+    """One page of the merged timeline and the cursor for the next one.
+
+    The cursor holds the last id consumed from every source ("12-7-30-0"), so a page costs one
+    bounded index range scan per source no matter how long the student's history is.
+    """
+    parts = before.split("-")
+    if len(parts) != len(TIMELINE_SOURCES):
+        parts = [""] * len(TIMELINE_SOURCES)
+    bounds = [int(p) if p.isdigit() else None for p in parts]
+    streams = []
+    for i, (sql, _) in enumerate(TIMELINE_SOURCES):
+        if bounds[i] is None:
+            rows = conn.execute(f"{sql} WHERE student_id=? ORDER BY id DESC LIMIT ?", (student_id, size + 1))
+        else:
+            rows = conn.execute(f"{sql} WHERE student_id=? AND id < ? ORDER BY id DESC LIMIT ?",
+                                (student_id, bounds[i], size + 1))
+        streams.append([(r["ts"], i, r) for r in rows])
+
+    merged = list(heapq.merge(*streams, key=lambda e: e[0], reverse=True))[:size + 1]
+    page = merged[:size]
+    next_before = None
+    if len(merged) > size:
+        for _, i, r in page:
+            bounds[i] = r["id"] if bounds[i] is None else min(bounds[i], r["id"])
+        next_before = "-".join("" if b is None else str(b) for b in bounds)
+
+    items = []
+    for ts, i, r in page:
+        kind, text = TIMELINE_SOURCES[i][1](r)
+        items.append({"ts": ts, "type": kind, "text": text})
+    return items, next_before
+
+
+def render_profile_page(conn, u, student, error=None, message=None):
+    before, size = page_args()
+    history, next_before = student_timeline(conn, student["id"], before, size)
+    return render_template("student_profile.html", user=u, student=student, history=history,
+                           pager=make_pager(next_before), role_ru=ROLE_RU.get(student["role"], student["role"]),
+                           roles=ROLE_RU, error=error, message=message)
+
+
+@app.route("/users/<int:uid>")
+@role_required("admin")
+def user_profile(uid: int):
+    conn = get_db()
+    student = conn.execute("SELECT * FROM users WHERE id=?", (uid,)).fetchone()
+    if not student:
+        return redirect("/users")
+    return render_profile_page(conn, current_user(), student)
+
+
+@app.route("/users/<int:uid>/role", methods=["POST"])
+@role_required("admin")
+def user_role(uid: int):
+    u = current_user()
+    conn = get_db()
+    student = conn.execute("SELECT * FROM users WHERE id=?", (uid,)).fetchone()
+    if not student:
+        return redirect("/users")
+    role = request.form.get("role", "")
+    if role not in ROLE_RU:
+        return render_profile_page(conn, u, student, error="Неизвестная роль.")
+    if uid == u["id"]:
+        return render_profile_page(conn, u, student, error="Свою роль изменить нельзя.")
+    if role == student["role"]:
+        return render_profile_page(conn, u, student)
+
+    conn.execute("UPDATE users SET role = ? WHERE id = ?", (role, uid))
+    revoke_sessions(conn, uid)  # the new role applies from the next login
+    add_notice("Роль изменена", f"{student['name']}: {ROLE_RU[student['role']]} → {ROLE_RU[role]}",
+               u["name"], "admin", commit=False)
+    conn.commit()
+    invalidate_conflicts()
+    student = conn.execute("SELECT * FROM users WHERE id=?", (uid,)).fetchone()
+    return render_profile_page(conn, u, student, message="Роль изменена, активные сессии пользователя завершены.")
+
+
+@app.route("/users/<int:uid>/timeline")
+@login_required
+def user_timeline(uid: int):
+    u = current_user()
+    if u["role"] != "admin" and u["id"] != uid:
+        return jsonify({"error": "Недостаточно прав."}), 403
+    before, size = page_args()
+    items, next_before = student_timeline(get_db(), uid, before, size)
+    return jsonify({"items": items, "next": next_before})
+
+
+@app.route("/users/import", methods=["POST"])
+@role_required("admin")
+def users_import():
+    u = current_user()
+    conn = get_db()
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        return render_users_page(conn, u, error="Выберите CSV-файл.")
+    try:
+        rows, errors = parse_user_import(upload.read(), request.form.get("work", "").strip())
+    except UnicodeDecodeError:
+        return render_users_page(conn, u, error="Файл должен быть в кодировке UTF-8.")
+    if not errors and not rows:
+        errors.append("В файле нет учеников.")
+
+    logins = [r[1] for r in rows]
+    repeated = sorted(login for login, n in Counter(logins).items() if n > 1)
+    taken = [r["login"] for r in conn.execute(
+        "SELECT login FROM users WHERE login IN (SELECT value FROM json_each(?))", (json.dumps(logins),))]
+    if repeated:
+        errors.append("Повторяются логины: " + ", ".join(repeated[:20]))
+    if taken:
+        errors.append("Логины уже заняты: " + ", ".join(taken[:20]))
+    if errors:
+        return render_users_page(conn, u, error=" ".join(errors[:10]))
+
+    hashed = passwords.hash_many(r[2] for r in rows)
+    rows = [r[:2] + (h,) + r[3:] for r, h in zip(rows, hashed)]
+    try:
+        conn.executemany(
+            "INSERT INTO users(role, login, password, name, work, benefit, allergy) VALUES(?,?,?,?,?,?,?)", rows)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return render_users_page(conn, u, error="Импорт отменён: логины уже заняты.")
+
+    invalidate_conflicts()
+    classes = sorted({r[4] for r in rows})
+    add_notice("Импорт учеников", f"Добавлено учеников: {len(rows)} ({', '.join(classes)})", u["name"], "admin")
+    return render_users_page(conn, u, message=f"Импортировано учеников: {len(rows)}.")
+
+
+def parse_period(default_days: int = 30):
+    try:
+        date_to = date.fromisoformat(request.values.get("to", "").strip())
+    except ValueError:
+        date_to = date.today()
+    try:
+        date_from = date.fromisoformat(request.values.get("from", "").strip())
+    except ValueError:
+        date_from = date_to - timedelta(days=default_days)
+    return min(date_from, date_to).isoformat(), date_to.isoformat()
+
+
+def term_summary(conn, date_from: str, date_to: str):
+    start, end = date_from, (date.fromisoformat(date_to) + timedelta(days=1)).isoformat()
+    serves = columnar.Table.load(conn, """
+        SELECT student_id, amount, count, substr(ts,1,10), meal_type, pay_type
+        FROM serves
+        WHERE ts >= ? AND ts < ?
+    """, (start, end), names=("student_id", "amount", "count", "day", "meal", "pay_type"),
+        encoded=("day", "meal", "pay_type"))
+    classes = {r["id"]: r["work"] for r in conn.execute("SELECT id, work FROM users WHERE role='student'")}
+    serves.add_lookup("student_id", "work", classes)
+    serves.add_bucket("day", "week")
+
+    tx = columnar.Table.load(
+        conn, "SELECT amount, type FROM transactions WHERE ts >= ? AND ts < ?",
+        (start, end), names=("amount", "type"), encoded=("type",)
+    )
+    menu = columnar.Table.load(
+        conn, "SELECT portions_total, meal_type FROM menu_items WHERE menu_date >= ? AND menu_date <= ?",
+        (date_from, date_to), names=("portions", "meal"), encoded=("meal",)
+    )
+
+    def by_meal(totals):
+        merged = {}
+        for meal, value in totals.items():
+            label = MEAL_RU.get(meal_key(meal), meal)
+            merged[label] = merged.get(label, 0) + value
+        return merged
+
+    return {
+        "serves": serves.size,
+        "revenue_by_class": {k: v for k, v in serves.group_sum("work", "amount").items() if v},
+        "revenue_by_meal": by_meal(serves.group_sum("meal", "amount")),
+        "portions_by_meal": by_meal(serves.group_sum("meal", "count")),
+        "planned_by_meal": by_meal(menu.group_sum("meal", "portions")),
+        "revenue_by_pay_type": serves.group_sum("pay_type", "amount"),
+        "revenue_by_week": serves.group_sum("week", "amount"),
+        "transactions_by_type": tx.group_sum("type", "amount"),
+        "spend_percentiles": columnar.percentiles(serves.group_totals("student_id", "amount")),
+    }
 
 
 @app.route("/analytics", endpoint="analytics")
 @role_required("admin")
 def analytics():
-    return _stub_page("Аналитика", "Раздел 'Аналитика' пока не реализован в app.py. Это заглушка, чтобы меню не падало.")
+    u = current_user()
+    conn = get_db()
+    date_from, date_to = parse_period()
+
+    by_day = {}
+    for r in conn.execute("""
+        SELECT day, meal, students FROM analytics_attendance
+        WHERE day >= ? AND day <= ?
+        ORDER BY day DESC
+    """, (date_from, date_to)):
+        row = by_day.setdefault(r["day"], {"date": r["day"], "breakfast": 0, "lunch": 0, "snack": 0})
+        if r["meal"] in row:
+            row[r["meal"]] += r["students"]
+
+    writeoffs = [{"date": r["day"], "item": r["item"], "count": r["count"], "reason": r["reason"]}
+                 for r in conn.execute("""
+                     SELECT day, item, reason, count FROM analytics_writeoffs
+                     WHERE day >= ? AND day <= ?
+                     ORDER BY day DESC, count DESC
+                 """, (date_from, date_to))]
+
+    summary = term_summary(conn, date_from, date_to) if request.args.get("summary") == "1" else None
+
+    return render_template("analytics.html", user=u, attendance=list(by_day.values()), writeoffs=writeoffs,
+                           summary=summary, date_from=date_from, date_to=date_to)
+
+
+@app.cli.command("rebuild-analytics")
+@click.option("--since", default="", help="Rebuild rollups from this day (YYYY-MM-DD); all history by default.")
+def rebuild_analytics_command(since):
+    conn = get_db_connection()
+    rebuild_analytics(conn, since)
+    conn.commit()
+    conn.close()
+    click.echo("Analytics rollups rebuilt.")
+
+
+@app.cli.command("hash-passwords")
+def hash_passwords_command():
+    """Hash plain-text passwords left from before hashing (they are also upgraded on login)."""
+    conn = get_db_connection()
+    rows = [r for r in conn.execute("SELECT id, password FROM users") if not passwords.is_hashed(r["password"])]
+    hashed = passwords.hash_many(r["password"] for r in rows)
+    conn.executemany("UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                     [(h, r["id"], r["password"]) for r, h in zip(rows, hashed)])
+    conn.commit()
+    conn.close()
+    click.echo(f"Hashed passwords: {len(rows)}.")
+
+
+@app.cli.command("balance-audit")
+def balance_audit_command():
+    """Compare users.balance with the transaction ledger and checkpoint long tails."""
+    conn = get_db_connection()
+    mismatched = [r for r in ledger_balances(conn) if r["balance"] != r["stored"]]
+    for r in mismatched:
+        click.echo(f"user {r['student_id']}: balance {r['stored']}, ledger {r['balance']}")
+    checkpoints = checkpoint_balances(conn)
+    conn.commit()
+    conn.close()
+    click.echo(f"Mismatched balances: {len(mismatched)}. New checkpoints: {checkpoints}.")
+
+
+@app.cli.command("sweep-subscriptions")
+def sweep_subscriptions_command():
+    conn = get_db_connection()
+    expiring, expired = sweep_subscriptions(conn)
+    conn.close()
+    click.echo(f"Expiring soon: {expiring}. Expired: {expired}.")
 
 
 @app.route("/sub")
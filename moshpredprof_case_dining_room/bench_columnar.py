@@ -0,0 +1,130 @@
+"""Benchmark: columnar aggregates vs. row-by-row sqlite3.Row iteration.
+
+Builds a throwaway database with N serves (1,000,000 by default) and computes
+revenue per class, per meal type, per pay type and per week plus per-student
+spend percentiles both ways, checking that the results match.
+
+    python bench_columnar.py [--rows 1000000] [--db path]
+"""
+import argparse
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, timedelta
+
+import columnar
+
+CLASSES = [f"{n}{letter}" for n in range(1, 12) for letter in "АБВ"]
+MEALS = ["завтрак", "обед", "закуска"]
+PAY_TYPES = ["balance", "subscription", "free"]
+
+QUERY = """
+    SELECT s.student_id, s.amount, s.ts, u.work, s.meal_type, s.pay_type
+    FROM serves s JOIN users u ON u.id = s.student_id
+    WHERE s.ts >= ? AND s.ts < ?
+"""
+
+
+def build_db(path: str, rows: int, students: int = 1500):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY, work TEXT NOT NULL);
+        CREATE TABLE serves (
+            id INTEGER PRIMARY KEY, ts TEXT NOT NULL, student_id INTEGER NOT NULL,
+            meal_type TEXT NOT NULL, count INTEGER NOT NULL, pay_type TEXT NOT NULL, amount INTEGER NOT NULL
+        );
+    """)
+    rnd = random.Random(1532)
+    conn.executemany("INSERT INTO users(id, work) VALUES(?,?)",
+                     [(i, rnd.choice(CLASSES)) for i in range(1, students + 1)])
+    start = date(2025, 9, 1)
+
+    def gen():
+        for _ in range(rows):
+            day = start + timedelta(days=rnd.randrange(270))
+            pay = rnd.choice(PAY_TYPES)
+            yield (f"{day.isoformat()} {rnd.randrange(8, 16):02d}:{rnd.randrange(60):02d}:00",
+                   rnd.randrange(1, students + 1), rnd.choice(MEALS), 1, pay,
+                   rnd.choice((40, 60, 80, 120, 180)) if pay == "balance" else 0)
+
+    # The app appends serves as they happen, so ids follow ts order.
+    conn.executemany("INSERT INTO serves(ts, student_id, meal_type, count, pay_type, amount) VALUES(?,?,?,?,?,?)",
+                     sorted(gen()))
+    conn.execute("CREATE INDEX idx_serves_ts ON serves(ts)")
+    conn.commit()
+    return conn
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    ordered = sorted(values)
+    out = {}
+    for q in qs:
+        pos = (len(ordered) - 1) * q / 100
+        lo, hi = math.floor(pos), math.ceil(pos)
+        out[q] = float(ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo))
+    return out
+
+
+def row_by_row(conn, start: str, end: str):
+    conn.row_factory = sqlite3.Row
+    by_class, by_meal, by_pay, by_week, per_student = {}, {}, {}, {}, {}
+    for r in conn.execute(QUERY, (start, end)):
+        amount = r["amount"]
+        day = date.fromisoformat(r["ts"][:10])
+        week = (day - timedelta(days=day.weekday())).isoformat()
+        by_class[r["work"]] = by_class.get(r["work"], 0) + amount
+        by_meal[r["meal_type"]] = by_meal.get(r["meal_type"], 0) + amount
+        by_pay[r["pay_type"]] = by_pay.get(r["pay_type"], 0) + amount
+        by_week[week] = by_week.get(week, 0) + amount
+        per_student[r["student_id"]] = per_student.get(r["student_id"], 0) + amount
+    conn.row_factory = None
+    return by_class, by_meal, by_pay, by_week, percentiles(per_student.values())
+
+
+def vectorized(conn, start: str, end: str):
+    t = columnar.Table.load(
+        conn, "SELECT student_id, amount, substr(ts,1,10), meal_type, pay_type FROM serves WHERE ts >= ? AND ts < ?",
+        (start, end), names=("student_id", "amount", "day", "meal", "pay_type"), encoded=("day", "meal", "pay_type"),
+    )
+    t.add_lookup("student_id", "work", dict(conn.execute("SELECT id, work FROM users")))
+    t.add_bucket("day", "week")
+    return (t.group_sum("work", "amount"), t.group_sum("meal", "amount"), t.group_sum("pay_type", "amount"),
+            t.group_sum("week", "amount"), columnar.percentiles(t.group_totals("student_id", "amount")))
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--db", help="reuse/create the benchmark database at this path")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+    else:
+        print(f"building {args.rows} serves in {path} ...")
+        conn = build_db(path, args.rows)
+
+    start, end = "2025-09-01", "2026-07-01"
+    slow, expected = timed(row_by_row, conn, start, end)
+    fast, got = timed(vectorized, conn, start, end)
+    for name, a, b in zip(("class", "meal", "pay", "week"), expected, got):
+        assert {k: v for k, v in a.items() if v} == {k: v for k, v in b.items() if v}, name
+    assert expected[4] == got[4], (expected[4], got[4])
+
+    backend = "numpy" if columnar.np is not None else "array"
+    print(f"row-by-row sqlite3.Row: {slow:.2f}s")
+    print(f"columnar ({backend}):   {fast:.2f}s  ({slow / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
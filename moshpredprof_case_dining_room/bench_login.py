@@ -0,0 +1,58 @@
+"""Benchmark: login throughput for each password hashing cost.
+
+Simulates a burst of N logins from concurrent request threads, each verifying
+through ``passwords.check`` (the same path /login uses), first cold and then
+again with the verified-password cache warm. Reports logins/s and p50/p95
+latency per method so the cost in ``passwords.METHOD`` can be tuned for the
+server it runs on.
+
+    python bench_login.py [--logins 64] [--clients 16] [--method scrypt:32768:8:1 ...]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import passwords
+
+METHODS = ["scrypt:32768:8:1", "scrypt:16384:8:1", "pbkdf2:sha256:600000"]
+
+
+def burst(users, clients: int):
+    def login(user):
+        uid, stored, password = user
+        started = time.perf_counter()
+        assert passwords.check(uid, stored, password)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = sorted(pool.map(login, users))
+    return time.perf_counter() - started, latencies
+
+
+def quantile(ordered, q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=16, help="concurrent request threads")
+    parser.add_argument("--workers", type=int, default=passwords.WORKERS, help="password pool size")
+    parser.add_argument("--method", action="append", help="hash method (repeatable); several costs by default")
+    args = parser.parse_args()
+
+    passwords.WORKERS = args.workers
+    print(f"{args.logins} logins, {args.clients} clients, {args.workers} hash workers")
+    for method in args.method or METHODS:
+        plain = [f"pass-{i}" for i in range(args.logins)]
+        users = [(i, passwords.hash_password(p, method), p) for i, p in enumerate(plain)]
+        passwords.clear_cache()
+        for label in ("cold", "cached"):
+            total, lat = burst(users, args.clients)
+            print(f"{method:<24} {label:<6} {args.logins / total:8.1f} logins/s"
+                  f"  p50 {quantile(lat, 0.5) * 1000:7.1f} ms  p95 {quantile(lat, 0.95) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Columnar aggregates for term-level reports.
+
+Rows are read from SQLite as plain tuples in fetchmany batches, transposed into
+compact integer columns (NumPy arrays when NumPy is installed, stdlib ``array``
+otherwise) and aggregated a column at a time. Text columns, including ISO
+dates, are dictionary encoded, so grouping and date bucketing work on small
+integer codes and each distinct date is parsed once, not once per row.
+"""
+import math
+from array import array
+from datetime import date, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_ROWS = 50_000
+WEEK_ANCHOR = date(1970, 1, 5)  # a Monday
+
+
+class Table:
+    def __init__(self, columns: dict, labels: dict):
+        self.columns = columns
+        self.labels = labels
+        self.size = len(next(iter(columns.values()))) if columns else 0
+
+    @classmethod
+    def load(cls, conn, sql: str, params=(), names=(), encoded=(), batch: int = BATCH_ROWS):
+        """Run ``sql`` and keep each selected column as an int64 column.
+
+        ``names`` name the selected columns in order; those listed in ``encoded``
+        are text and get stored as codes into ``labels[name]``.
+        """
+        raw = {name: array("q") for name in names}
+        index = {name: {} for name in encoded}
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for name, values in zip(names, zip(*rows)):
+                if name in index:
+                    codes = index[name]
+                    for v in set(values).difference(codes):
+                        codes[v] = len(codes)
+                    values = map(codes.__getitem__, values)
+                elif None in values:
+                    values = [0 if v is None else v for v in values]
+                raw[name].extend(values)
+        cur.close()
+        columns = {name: _to_vector(col) for name, col in raw.items()}
+        labels = {name: list(codes) for name, codes in index.items()}
+        return cls(columns, labels)
+
+    def add_lookup(self, source: str, name: str, mapping: dict, missing="—"):
+        """Add encoded column ``name`` = mapping[value of ``source``] for every row."""
+        labels = sorted({str(v) for v in mapping.values()} | {missing})
+        code_of = {label: i for i, label in enumerate(labels)}
+        lut = {key: code_of[str(value)] for key, value in mapping.items()}
+        col = self.columns[source]
+        if np is not None and len(col):
+            table = np.full(max(int(col.max()), max(lut, default=0)) + 1, code_of[missing], dtype=np.int64)
+            table[list(lut)] = list(lut.values())
+            codes = table[col]
+        else:
+            fallback = code_of[missing]
+            codes = array("q", (lut.get(v, fallback) for v in col))
+        self._set_encoded(name, codes, labels)
+
+    def add_bucket(self, source: str, name: str, width: int = 7, anchor: date = WEEK_ANCHOR):
+        """Bucket the encoded ISO dates of ``source`` into ``width``-day periods.
+
+        Buckets are aligned to ``anchor`` (Mondays by default) and labelled by
+        their first day.
+        """
+        starts = []
+        for label in self.labels[source]:
+            day = date.fromisoformat(str(label)[:10])
+            starts.append((day - timedelta(days=(day - anchor).days % width)).isoformat())
+        labels = sorted(set(starts))
+        code_of = {label: i for i, label in enumerate(labels)}
+        lut = [code_of[s] for s in starts]
+        col = self.columns[source]
+        if np is not None:
+            codes = np.asarray(lut, dtype=np.int64)[col] if len(col) else np.zeros(0, dtype=np.int64)
+        else:
+            codes = array("q", map(lut.__getitem__, col))
+        self._set_encoded(name, codes, labels)
+
+    def group_sum(self, key: str, value: str = None) -> dict:
+        """Sum ``value`` (or count rows when None) per label of encoded column ``key``."""
+        codes = self.columns[key]
+        labels = self.labels[key]
+        if np is not None:
+            weights = None if value is None else self.columns[value]
+            totals = np.bincount(codes, weights=weights, minlength=len(labels))
+            return {label: int(totals[i]) for i, label in enumerate(labels)}
+        totals = [0] * len(labels)
+        if value is None:
+            for c in codes:
+                totals[c] += 1
+        else:
+            for c, v in zip(codes, self.columns[value]):
+                totals[c] += v
+        return dict(zip(labels, totals))
+
+    def group_totals(self, key: str, value: str):
+        """Totals of ``value`` per distinct value of a raw integer column (e.g. student id)."""
+        codes = self.columns[key]
+        if np is not None:
+            if not len(codes):
+                return np.zeros(0, dtype=np.int64)
+            _, inverse = np.unique(codes, return_inverse=True)
+            return np.bincount(inverse, weights=self.columns[value]).astype(np.int64)
+        totals = {}
+        for c, v in zip(codes, self.columns[value]):
+            totals[c] = totals.get(c, 0) + v
+        return array("q", totals.values())
+
+    def _set_encoded(self, name: str, codes, labels: list):
+        self.columns[name] = codes
+        self.labels[name] = labels
+
+
+def percentiles(values, qs=(50, 90, 99)) -> dict:
+    """Linear-interpolated percentiles (same method as numpy.percentile)."""
+    if not len(values):
+        return {q: 0.0 for q in qs}
+    if np is not None:
+        return {q: float(p) for q, p in zip(qs, np.percentile(values, qs))}
+    ordered = sorted(values)
+    result = {}
+    for q in qs:
+        pos = (len(ordered) - 1) * q / 100
+        lo, hi = math.floor(pos), math.ceil(pos)
+        result[q] = float(ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo))
+    return result
+
+
+def _to_vector(col: array):
+    if np is not None:
+        return np.frombuffer(col, dtype=np.int64) if len(col) else np.zeros(0, dtype=np.int64)
+    return col
@@ -0,0 +1,115 @@
+"""Password hashing with a tunable cost, verified on a small worker pool.
+
+Hashes use werkzeug's salted format (``scrypt:N:r:p$salt$hash`` or
+``pbkdf2:sha256:iterations$salt$hash``); ``METHOD`` sets the cost for new
+hashes and anything stored with a different method (or in plain text, as
+older rows are) is reported by ``needs_rehash``.
+
+The KDF releases the GIL, so verifying on a pool keeps other request threads
+running, and the pool size caps how many hashes (and scrypt's memory) run at
+once during a login burst: extra logins queue instead of starving the server.
+Successful checks are remembered for ``CACHE_TTL`` seconds under an HMAC with a
+per-process key, so repeated logins with the same password skip the KDF.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+METHOD = "scrypt:32768:8:1"  # ~32 MiB and 0.1-0.2 s per hash; lower N for weak hardware
+WORKERS = max(2, os.cpu_count() or 2)
+BULK_WORKERS = max(1, WORKERS // 2)  # imports hash on their own pool so logins keep every WORKERS slot
+VERIFY_TIMEOUT = 10  # seconds a login waits for a free worker before giving up
+REHASH_TIMEOUT = 2  # an upgrade of a valid login's hash is skipped rather than waited for
+CACHE_TTL = 600
+CACHE_SIZE = 4096
+
+_KDF_PREFIXES = ("scrypt:", "pbkdf2:")
+_CACHE_KEY = os.urandom(32)
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_pool = None
+_bulk_pool = None
+_dummy = []
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="password")
+        return _pool
+
+
+def _bulk_executor() -> ThreadPoolExecutor:
+    global _bulk_pool
+    with _lock:
+        if _bulk_pool is None:
+            _bulk_pool = ThreadPoolExecutor(max_workers=BULK_WORKERS, thread_name_prefix="password-bulk")
+        return _bulk_pool
+
+
+def run(fn, *args, timeout=VERIFY_TIMEOUT):
+    """Run ``fn`` on the password pool and wait; raises concurrent.futures.TimeoutError when saturated."""
+    return _executor().submit(fn, *args).result(timeout)
+
+
+def hash_password(password: str, method: str = None) -> str:
+    return generate_password_hash(password, method=method or METHOD)
+
+
+def hash_many(passwords) -> list:
+    return list(_bulk_executor().map(hash_password, passwords))
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(_KDF_PREFIXES) and stored.count("$") == 2
+
+
+def needs_rehash(stored: str, method: str = None) -> bool:
+    return not is_hashed(stored) or stored.split("$", 1)[0] != (method or METHOD)
+
+
+def verify(stored: str, password: str) -> bool:
+    if is_hashed(stored):
+        return check_password_hash(stored, password)
+    return hmac.compare_digest(stored.encode(), password.encode())  # legacy plain-text row
+
+
+def dummy_hash() -> str:
+    # Checked for unknown logins so they cost the same as wrong passwords.
+    if not _dummy:
+        _dummy.append(hash_password(os.urandom(16).hex()))
+    return _dummy[0]
+
+
+def check(key, stored: str, password: str) -> bool:
+    """Verify ``password`` for account ``key`` on the pool, using the cache of recent successes."""
+    token = hmac.new(_CACHE_KEY, f"{key}\0{stored}\0{password}".encode(), hashlib.sha256).digest()
+    now = time.monotonic()
+    with _lock:
+        expires = _cache.get(token)
+        if expires is not None:
+            if expires > now:
+                _cache.move_to_end(token)
+                return True
+            del _cache[token]
+
+    ok = run(verify, stored, password)
+    if ok and key is not None:
+        with _lock:
+            _cache[token] = now + CACHE_TTL
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return ok
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()